@@ -28,6 +28,35 @@ tp.dataset.val_split = 0.2
 tp.dataset.random_seed = 0
 # Set to a local directory to stored the loaded dataset on disk instead of in memory
 tp.dataset.memmap_directory = None
+# Image loading workers: "process" or "thread" (threads can be faster as the image decoders release the GIL)
+tp.dataset.loader_backend = "process"
+# Keep the loaded images in a cache shared by all datasets (in the memmap directory, or ~/miso_cache if not set),
+# so that only images not seen before are loaded
+tp.dataset.incremental_cache = False
+# How images are identified in the cache: "stat" (path, size and modification time) or "content" (hash of the file)
+tp.dataset.cache_identity = "stat"
+# Maximum size of the memmap / cache directory, e.g. "50G". If set, loaded images are kept for reuse by later runs and
+# the least recently used are deleted when over the limit. Inspect or prune with:
+# python -m miso.data.cache_manager DIRECTORY list
+tp.dataset.cache_quota = None
+# Also cache the images at these sizes, e.g. [[64, 64], [128, 128], [224, 224]], so that changing tp.cnn.img_shape to
+# any of them does not need the images to be decoded again (uses the incremental cache)
+tp.dataset.cache_pyramid = None
+# Decode the images when they are first used during training instead of loading them all before training, keeping at
+# most lazy_cache_size of decoded images in memory. Use for datasets that are too large to load.
+tp.dataset.lazy = False
+tp.dataset.lazy_cache_size = "4G"
+# Image resizing: "skimage" or "fast" (resizes 8 and 16 bit images without converting to float, using area
+# interpolation, several times faster but the images differ slightly)
+tp.dataset.resize_backend = "skimage"
+# Image decoding: "skimage" or "pillow" (large JPEG images are decoded at a reduced resolution, much faster)
+tp.dataset.decoder = "skimage"
+# Keep the vectors calculated by transfer learning networks in a cache (in the memmap directory, or ~/miso_cache if
+# not set), so that retraining on the same images only calculates the vectors of images not seen before
+tp.dataset.feature_cache = False
+# Data type to store the vectors and predictions calculated for the whole dataset: "float32" or "float16" (half the
+# memory). If the memmap directory is set they are stored on disk there instead of in memory.
+tp.dataset.vector_dtype = "float32"
 
 # -----------------------------------------------------------------------------
 # CNN
@@ -76,6 +105,17 @@ tp.training.max_epochs = 10
 tp.training.alr_epochs = 10
 # Number of learning rate drops after which training is suspended
 tp.training.alr_drops = 4
+# Number of batches between checks of the training loss by the adaptive learning rate scheduler, so the learning rate
+# can drop within an epoch (None to check at the end of each epoch)
+# tp.training.alr_monitor_steps = 50
+# Number of batches in an epoch (None for one pass through the training images). Use with alr_monitor_steps to make
+# alr_epochs and max_epochs shorter "virtual" epochs on large datasets
+# tp.training.steps_per_epoch = 500
+# Number of epochs between checkpoints of the training state (model, optimizer, learning rate scheduler and data order),
+# saved in the checkpoint directory of the run (None for no checkpoints)
+# tp.training.checkpoint_every = 5
+# Directory of an interrupted run to resume training from its latest checkpoint (None to start a new run)
+# tp.training.resume_from = "output/olzo_mini_20200101-120000"
 # Monitor the validation loss instead?
 tp.training.monitor_val_loss = False
 # Use class weighting?
@@ -84,6 +124,14 @@ tp.training.use_class_weights = True
 tp.training.use_class_undersampling = False
 # Use train time augmentation?
 tp.training.use_augmentation = True
+# Input pipeline: "generator" (one image at a time) or "index" (whole batches read at once, faster, tensorflow 2 only)
+tp.training.pipeline = "generator"
+# Transfer learning tail training: "keras" (dense network trained with the adaptive learning rate schedule), or for a
+# model in seconds on the CPU: "logistic" (logistic regression), "ridge" (ridge classifier) or "mlp" (the same dense
+# network trained with full batch L-BFGS)
+tp.training.tl_tail = "keras"
+# Use class indices as labels instead of one hot vectors (less memory for datasets with many images and classes)
+tp.training.sparse_labels = False
 
 # -----------------------------------------------------------------------------
 # Augmentation
@@ -108,6 +156,13 @@ tp.augmentation.gaussian_noise = None
 # If random crop is used, you MUST set the original image size that the crop is taken from
 tp.augmentation.random_crop = None
 tp.augmentation.orig_img_shape = [256, 256, 3]
+# Precompute this many rotated / zoomed / cropped variants of each image before training (stored beside the image
+# memmap) so that only the gain, gamma, bias and noise augmentations are computed during training, e.g. 8
+tp.augmentation.offline_variants = None
+# Transfer learning: calculate this many vectors of randomly augmented copies of each image (rotation, zoom, gain,
+# gamma, bias, noise) and train the tail on a random one of them each epoch, e.g. 8. Stored in the feature cache if
+# tp.dataset.feature_cache is set.
+tp.augmentation.feature_views = None
 
 # -----------------------------------------------------------------------------
 # Output
@@ -118,6 +173,10 @@ tp.output.save_dir = "output"
 tp.output.save_model = True
 # Save the mislabelled image analysis?
 tp.output.save_mislabeled = False
+# Transfer learning: also rank the images by how suspicious their label is, using the probabilities from tails trained
+# in parallel on this many folds of the vectors, each predicting the images it was not trained on, e.g. 5
+# (written to suspicious_labels.csv)
+tp.output.mislabeled_folds = None
 
 
 
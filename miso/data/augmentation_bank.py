@@ -0,0 +1,169 @@
+"""
+Offline augmentation bank
+
+K randomly rotated, zoomed and cropped variants of each image are computed once, before training, and stored in a
+memmap beside the image memmap (or in RAM if the images are in RAM). During training a random variant of each image
+is chosen each epoch, so that only the cheap photometric augmentations (gain, gamma, noise, bias) are computed online.
+"""
+import numpy as np
+from scipy import ndimage as nd
+
+from miso.data.dataset import DatasetBase
+from miso.data.image_cache import CacheView
+from miso.data.image_loader import ParallelImageLoader, is_file_memmap
+from miso.data.tf_generator import TFGenerator
+
+
+def random_parameter(rng, values, size):
+    """
+    Same distribution as the tf augmentation: values of length 2 are a range to draw uniformly from, longer lists are
+    values to choose from
+    """
+    if len(values) > 2:
+        return rng.choice(np.asarray(values, dtype=np.float32), size)
+    elif len(values) == 2:
+        return rng.uniform(values[0], values[1], size)
+    else:
+        raise ValueError("Augmentation parameters need at least 2 values")
+
+
+class AffineVariants:
+    """
+    Picklable transform that creates randomly rotated, zoomed and cropped variants of an image, with the same
+    parameter distributions and geometry as miso.training.tf_augmentation.aug_geometric
+    """
+    def __init__(self, num_variants, rotation=None, zoom=None, random_crop=None, seed=0):
+        self.num_variants = num_variants
+        self.rotation = rotation
+        self.zoom = zoom
+        self.random_crop = random_crop
+        self.seed = seed
+
+    def __call__(self, item):
+        row, im = item
+        # Seeded by the row so that the variants do not depend on which worker creates them
+        rng = np.random.RandomState((self.seed * 1000003 + row) % (2 ** 32))
+        k = self.num_variants
+        height, width = im.shape[:2]
+        if self.rotation is None:
+            angles = np.zeros(k)
+        elif len(self.rotation) == 2:
+            angles = rng.uniform(self.rotation[0] / 180 * np.pi, self.rotation[1] / 180 * np.pi, k)
+        else:
+            angles = random_parameter(rng, self.rotation, k)
+        zooms = np.ones(k) if self.zoom is None else random_parameter(rng, self.zoom, k)
+        if self.random_crop is None:
+            out_shape = (height, width)
+            offsets = np.zeros((k, 2))
+        else:
+            out_shape = tuple(self.random_crop[:2])
+            offsets = np.stack([rng.randint(0, height - out_shape[0] + 1, k),
+                                rng.randint(0, width - out_shape[1] + 1, k)], axis=1)
+        centre = np.array([(height - 1) / 2, (width - 1) / 2])
+        max_value = np.iinfo(im.dtype).max if im.dtype.kind in 'ui' else None
+        out = np.zeros((k,) + out_shape + im.shape[2:], dtype=im.dtype)
+        for i in range(k):
+            cos, sin, z = np.cos(angles[i]), np.sin(angles[i]), zooms[i]
+            # Maps output (row, col) to input (row, col), see tf_augmentation.geometric_transform
+            matrix = z * np.array([[cos, sin], [-sin, cos]])
+            offset = matrix @ (offsets[i] - centre) + centre
+            for c in range(im.shape[2]):
+                res = nd.affine_transform(im[:, :, c].astype(np.float32), matrix, offset, output_shape=out_shape,
+                                          order=1, mode='constant', cval=0)
+                if max_value is not None:
+                    res = np.clip(np.round(res), 0, max_value)
+                out[i, :, :, c] = res
+        return out
+
+
+class SourceReader:
+    """
+    Picklable reader of the images of a dataset. Memory mapped images are reopened in each worker process.
+    """
+    def __init__(self, data):
+        self.rows = None
+        if isinstance(data, CacheView):
+            self.rows = data.rows
+            data = data.data
+        self.data = data
+        self.memmap = is_file_memmap(data)
+        if self.memmap:
+            self.filename = data.filename
+            self.offset = data.offset
+            self.shape = data.shape
+            self.dtype = data.dtype
+
+    def __call__(self, row):
+        if self.data is None:
+            self.data = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+        source_row = row if self.rows is None else self.rows[row]
+        return row, np.array(self.data[source_row])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.memmap:
+            state['data'] = None
+        return state
+
+
+class AugmentationBank(DatasetBase):
+    def __init__(self,
+                 images,
+                 num_variants,
+                 rotation=None,
+                 zoom=None,
+                 random_crop=None,
+                 seed=0):
+        """
+        Precomputed geometric augmentations of an ImageDataset
+        :param images: The (loaded) ImageDataset
+        :param num_variants: Number of augmented variants of each image
+        :param rotation: Rotation parameters, as for aug_all_fn
+        :param zoom: Zoom parameters, as for aug_all_fn
+        :param random_crop: Random crop size, as for aug_all_fn
+        :param seed: Random seed
+        """
+        super().__init__(memmap_directory=images.memmap_directory, dtype=images.dtype, cache_quota=images.cache_quota)
+        self.images = images
+        self.num_variants = num_variants
+        self.transform = AffineVariants(num_variants, rotation, zoom, random_crop, seed)
+        img_size = tuple(images.data.shape[1:])
+        if random_crop is not None:
+            img_size = tuple(random_crop[:2]) + img_size[2:]
+        self.img_size = img_size
+        self.arr_size = (len(images.data), num_variants) + img_size
+        self.hash_data = ["AugmentationBank", images.hash_data, num_variants, rotation, zoom, random_crop, seed]
+
+    def load(self):
+        print('-' * 80)
+        print("Creating augmentation bank")
+        print("- {} variants per image, array size is {}".format(self.num_variants, self.arr_size))
+        if self.read_or_create_data(self.arr_size, self.dtype) is not True:
+            source = SourceReader(self.images.data)
+            backend = self.images.loader_backend if source.memmap else 'thread'
+            loader = ParallelImageLoader(np.arange(len(self.images.data)),
+                                         self.data,
+                                         transform_fn=self.transform,
+                                         backend=backend,
+                                         completion=self.completion,
+                                         read_fn=source)
+            loader.load()
+            self.update_cache()
+
+    def create_generator(self, batch_size, idxs=None, map_fn=TFGenerator.map_fn_divide_255, shuffle=True,
+                         one_shot=False, undersample=False, random_seed=None):
+        # Each sample is a random variant of the image, chosen each epoch
+        data = self.data.reshape((-1,) + self.img_size)
+        gen = TFGenerator(data,
+                          self.images.cls,
+                          idxs=idxs,
+                          batch_size=batch_size,
+                          map_fn=map_fn,
+                          shuffle=shuffle,
+                          one_shot=one_shot,
+                          undersample=undersample,
+                          output_channels=self.images.output_channels,
+                          pipeline=self.images.pipeline,
+                          variants=self.num_variants,
+                          random_seed=random_seed)
+        return gen
@@ -0,0 +1,224 @@
+"""
+Management of the memmap / image cache directory
+
+Each entry in the directory (a memmap file and its completion file, or an image or feature cache store directory) is
+recorded in a manifest with its size and last use time. When a quota is set, the least recently used entries are
+deleted to keep the directory under the quota. Only files and directories named as created by miso are managed, anything
+else in the directory is left alone.
+
+The manifest is reloaded and saved under a lock file each time it is changed, so several managers of the same directory
+(e.g. training runs at the same time) do not overwrite each other's updates.
+
+Command line usage:
+python -m miso.data.cache_manager DIRECTORY list
+python -m miso.data.cache_manager DIRECTORY prune --quota 50G
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import shutil
+import time
+from collections import OrderedDict
+
+from miso.utils.lock import FileLock
+
+SIZE_UNITS = {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}
+
+
+def parse_size(size):
+    """
+    Parses a size in bytes, e.g. 1000, "500M", "50G" or "1.5T"
+    """
+    if size is None or isinstance(size, (int, float)):
+        return size
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)B?\s*", size.upper())
+    if match is None:
+        raise ValueError("Could not parse size {}, use e.g. 500M, 50G, 1.5T".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(size):
+    for unit in ['T', 'G', 'M', 'K']:
+        if size >= SIZE_UNITS[unit]:
+            return "{:.1f}{}B".format(size / SIZE_UNITS[unit], unit)
+    return "{}B".format(size)
+
+
+class CacheManager:
+    MANIFEST = "manifest.json"
+    LOCK = "manifest.lock"
+    # Memmap files (16 character hash id) and image / feature cache stores (including pyramid levels)
+    MEMMAP_PATTERN = re.compile(r"[0-9a-f]{16}")
+    STORE_PATTERN = re.compile(r"(images|features)_[0-9a-f]{16}")
+    MEMMAP_SUFFIXES = (".npy", ".done.npy")
+
+    def __init__(self, directory, quota=None):
+        """
+        Manages the entries in a cache directory
+        :param directory: The cache directory
+        :param quota: Maximum total size of the entries in bytes (or a string such as "50G"), None for no limit
+        """
+        self.directory = directory
+        self.quota = parse_size(quota)
+        self.manifest_file = os.path.join(directory, self.MANIFEST)
+        self.entries = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        self.lock = FileLock(os.path.join(directory, self.LOCK))
+        self.scan()
+
+    def load(self):
+        """
+        Reads the manifest. Call with the lock held.
+        """
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.entries = OrderedDict(json.load(f))
+
+    def save(self):
+        """
+        Writes the manifest. Call with the lock held.
+        """
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_file, self.manifest_file)
+
+    def entry_name(self, path):
+        """
+        Name of the entry that a file or directory in the cache directory belongs to, or None if it was not created by
+        miso
+        """
+        if os.path.isdir(os.path.join(self.directory, path)):
+            return path if self.STORE_PATTERN.fullmatch(path) else None
+        for suffix in self.MEMMAP_SUFFIXES:
+            name = path[:-len(suffix)]
+            if path.endswith(suffix) and self.MEMMAP_PATTERN.fullmatch(name):
+                return name
+        return None
+
+    def is_entry(self, name):
+        return self.STORE_PATTERN.fullmatch(name) is not None or self.MEMMAP_PATTERN.fullmatch(name) is not None
+
+    def entry_paths(self, name):
+        """
+        Files and directories belonging to an entry, i.e. a store directory called name or the memmap files name.npy
+        and name.done.npy
+        """
+        if self.STORE_PATTERN.fullmatch(name):
+            path = os.path.join(self.directory, name)
+            return [path] if os.path.isdir(path) else []
+        if self.MEMMAP_PATTERN.fullmatch(name):
+            paths = [os.path.join(self.directory, name + suffix) for suffix in self.MEMMAP_SUFFIXES]
+            return [path for path in paths if os.path.isfile(path)]
+        return []
+
+    def entry_size(self, name):
+        size = 0
+        for path in self.entry_paths(name):
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+            else:
+                size += os.path.getsize(path)
+        return size
+
+    def scan(self):
+        """
+        Synchronises the manifest with the directory contents. Entries not in the manifest are added using their
+        modification time as the last use time.
+        """
+        with self.lock:
+            self.load()
+            names = set()
+            for path in os.listdir(self.directory):
+                name = self.entry_name(path)
+                if name is not None:
+                    names.add(name)
+            for name in list(self.entries.keys()):
+                if name not in names:
+                    del self.entries[name]
+            for name in names:
+                if name not in self.entries:
+                    mtime = max(os.path.getmtime(p) for p in self.entry_paths(name))
+                    self.entries[name] = {'size': self.entry_size(name), 'last_used': mtime}
+            self.save()
+
+    def total_size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def touch(self, name):
+        """
+        Records that an entry has been used, and updates its size
+        """
+        with self.lock:
+            self.load()
+            self.entries[name] = {'size': self.entry_size(name), 'last_used': time.time()}
+            self.save()
+
+    def remove(self, name):
+        if not self.is_entry(name):
+            raise ValueError("{} is not a cache entry".format(name))
+        with self.lock:
+            self.load()
+            for path in self.entry_paths(name):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            self.entries.pop(name, None)
+            self.save()
+
+    def evict(self, extra=0, keep=()):
+        """
+        Deletes the least recently used entries until the total size plus extra bytes is under the quota
+        :param extra: Number of bytes about to be added
+        :param keep: Names of entries that must not be deleted (e.g. those in use)
+        :return: List of deleted entries
+        """
+        if self.quota is None:
+            return []
+        removed = []
+        with self.lock:
+            self.load()
+            total = self.total_size() + extra
+            for name, entry in sorted(self.entries.items(), key=lambda kv: kv[1]['last_used']):
+                if total <= self.quota:
+                    break
+                if name in keep:
+                    continue
+                print("- evicting {} from cache ({})".format(name, format_size(entry['size'])))
+                total -= entry['size']
+                self.remove(name)
+                removed.append(name)
+        if total > self.quota:
+            print("! cache size {} is over quota {} after eviction".format(format_size(total), format_size(self.quota)))
+        return removed
+
+    def summary(self):
+        print("Cache directory: {}".format(self.directory))
+        for name, entry in sorted(self.entries.items(), key=lambda kv: kv[1]['last_used'], reverse=True):
+            last_used = datetime.datetime.fromtimestamp(entry['last_used'])
+            print("- {:40s} {:>10s}  last used {:%Y-%m-%d %H:%M}".format(name, format_size(entry['size']), last_used))
+        quota = "none" if self.quota is None else format_size(self.quota)
+        print("Total: {} in {} entries (quota: {})".format(format_size(self.total_size()), len(self.entries), quota))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and prune a MISO memmap / image cache directory")
+    parser.add_argument("directory", help="Cache directory (memmap_directory, or ~/miso_cache)")
+    parser.add_argument("command", choices=["list", "prune"], help="list: show entries, prune: delete least recently used entries")
+    parser.add_argument("--quota", default=None, help="Maximum size to prune to, e.g. 50G")
+    parser.add_argument("--all", action='store_true', help="Delete all entries")
+    args = parser.parse_args()
+
+    if args.command == "prune" and args.all:
+        args.quota = 0
+    manager = CacheManager(args.directory, args.quota)
+    if args.command == "prune":
+        if manager.quota is None:
+            parser.error("prune requires --quota or --all")
+        removed = manager.evict()
+        print("Removed {} entries".format(len(removed)))
+    manager.summary()
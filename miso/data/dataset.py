@@ -4,18 +4,39 @@ import numpy as np
 from numpy.lib.format import open_memmap
 import gc
 
+from miso.data.cache_manager import CacheManager
+
 
 class DatasetBase:
-    def __init__(self, memmap_directory=None, overwrite_memmap=False, dtype=np.uint8):
+    def __init__(self, memmap_directory=None, overwrite_memmap=False, dtype=np.uint8, cache_quota=None):
+        """
+        :param memmap_directory: Directory to store the memmap file, if None the data is stored in RAM
+        :param overwrite_memmap: Recreate the memmap file even if it already exists
+        :param dtype: Data type
+        :param cache_quota: If not None, the memmap directory is managed as a cache: memmap files are kept after
+        release for reuse, and the least recently used files are deleted to keep the directory under this
+        size in bytes (or a string such as "50G")
+        """
         self.memmap_directory = memmap_directory
         self.overwrite_memmap = overwrite_memmap
+        self.cache_quota = cache_quota
+        self.cache_manager = None
         self.memmap_file = None
+        self.completion_file = None
         self.hash_data = None
         self.data = None
+        self.completion = None
         self.shape = None
         self.dtype = dtype
 
     def read_or_create_data(self, shape, dtype):
+        """
+        Opens the memmap file for this dataset if it exists, otherwise creates it (or creates an array in RAM if
+        no memmap directory is set).
+        Alongside the memmap file is a completion bitmap (one byte per entry) recording which entries have been
+        written, so that an interrupted load can be resumed by loading only the missing entries.
+        :return: True if the data exists and is complete
+        """
         self.shape = shape
         self.dtype = dtype
 
@@ -26,21 +47,34 @@ class DatasetBase:
             if self.hash_data is None:
                 raise ValueError("Please set the hash_data (as a numpy array) to use memory mapping")
             self.memmap_file = os.path.join(self.memmap_directory, self.get_hash_id() + ".npy")
+            self.completion_file = os.path.join(self.memmap_directory, self.get_hash_id() + ".done.npy")
+            if self.cache_quota is not None:
+                self.cache_manager = CacheManager(self.memmap_directory, self.cache_quota)
             if self.overwrite_memmap is False and os.path.exists(self.memmap_file):
                 print("Existing data found at {}".format(self.memmap_file))
-                self.data = open_memmap(self.memmap_file, mode='r+', dtype=self.dtype, shape=self.shape)
-                # Check if not all zeros
-                # If all zeros, usually indication of an error creating the memmap file previously, therefore recreate
-                if np.count_nonzero(self.data[0]) > 0 and np.count_nonzero(self.data[-1]) > 0:
-                    return True
+                # Without a completion bitmap we cannot know which entries are valid, therefore recreate
+                if os.path.exists(self.completion_file):
+                    self.data = open_memmap(self.memmap_file, mode='r+', dtype=self.dtype, shape=self.shape)
+                    self.completion = open_memmap(self.completion_file, mode='r+', dtype=np.uint8, shape=(self.shape[0],))
+                    num_complete = np.count_nonzero(self.completion)
+                    if num_complete == self.shape[0]:
+                        self.update_cache()
+                        return True
+                    print("Data is incomplete ({} of {} entries), resuming.".format(num_complete, self.shape[0]))
+                    return False
                 else:
-                    self.data._mmap.close()
-                    print("File was likely corrupted, recreating.")
+                    print("No completion record found, recreating.")
+            if self.cache_manager is not None:
+                nbytes = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+                self.cache_manager.evict(extra=nbytes, keep=[self.get_hash_id()])
             print("Creating memmap file at {}".format(self.memmap_file))
             os.makedirs(self.memmap_directory, exist_ok=True)
             self.data = open_memmap(self.memmap_file, mode='w+', dtype=self.dtype, shape=self.shape)
+            self.completion = open_memmap(self.completion_file, mode='w+', dtype=np.uint8, shape=(self.shape[0],))
+            self.update_cache()
         else:
             self.data = np.zeros(self.shape, dtype=self.dtype)
+            self.completion = np.zeros(self.shape[0], dtype=np.uint8)
 
         return False
 
@@ -55,15 +89,36 @@ class DatasetBase:
         else:
             return hashlib.sha256(repr(self.hash_data).encode('UTF-8')).hexdigest()[0:16]
 
+    def update_cache(self):
+        """
+        Records the use of the memmap file in the cache manifest (if the memmap directory is managed)
+        """
+        if self.cache_manager is not None:
+            self.cache_manager.touch(self.get_hash_id())
+
     def release(self):
         if self.memmap_file is None:
             del self.data
+        elif self.cache_manager is not None:
+            # Keep the memmap file for reuse
+            self.data._mmap.close()
+            del self.data
+            self.completion._mmap.close()
+            del self.completion
+            gc.collect()
+            self.update_cache()
+            self.memmap_file = None
+            self.completion_file = None
         else:
             if os.path.exists(self.memmap_file):
                 self.data._mmap.close()
                 del self.data
                 gc.collect()
                 os.remove(self.memmap_file)
+            if os.path.exists(self.completion_file):
+                self.completion._mmap.close()
+                del self.completion
+                gc.collect()
+                os.remove(self.completion_file)
             self.memmap_file = None
-
-
+            self.completion_file = None
@@ -0,0 +1,120 @@
+"""
+Transfer learning feature cache
+
+The vectors computed by a transfer learning head are stored in an ArrayStore, one store per head (CNN id and image
+shape), indexed by a hash of the contents of each (transformed) image. Retraining on the same images, e.g. with a
+different validation split or tail, reads the vectors from the store instead of running the head again, and only
+images not seen before are passed through the head.
+
+Augmented views of the images (several vectors per image, each from a randomly augmented copy) are kept in a separate
+store for each set of augmentation parameters.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from miso.data.image_cache import ArrayStore
+
+
+def image_keys(data, chunk_size=256):
+    """
+    Key of each image made from a hash of its contents, shape and data type
+    :param data: Array (or array-like) of images
+    :param chunk_size: Number of images read at once
+    :return: List of string keys
+    """
+    keys = []
+    for start in range(0, len(data), chunk_size):
+        chunk = np.ascontiguousarray(data[start:start + chunk_size])
+        for im in chunk:
+            h = hashlib.blake2b(digest_size=20)
+            h.update("{}|{}|".format(im.shape, im.dtype.str).encode('UTF-8'))
+            h.update(im.tobytes())
+            keys.append("blake2b:" + h.hexdigest())
+    return keys
+
+
+class FeatureCache:
+    def __init__(self, directory, cnn_id, img_shape, vector_shape, dtype=np.float32, cache_manager=None,
+                 augmentation=None):
+        """
+        Store of the vectors of a transfer learning head
+        :param directory: Cache directory containing the stores
+        :param cnn_id: Id of the network, e.g. resnet50_tl
+        :param img_shape: Input image shape of the network
+        :param vector_shape: Shape of the vector output by the head
+        :param dtype: Data type of the vectors
+        :param cache_manager: If not None, the store is recorded in the cache manager and other entries are evicted to
+        make room for new vectors
+        :param augmentation: Augmentation parameters used to create augmented views (None if not augmented)
+        """
+        self.cnn_id = cnn_id
+        self.img_shape = [int(v) for v in img_shape]
+        self.vector_shape = tuple(int(v) for v in vector_shape)
+        self.dtype = np.dtype(dtype)
+        self.cache_manager = cache_manager
+        params = {'cnn_id': cnn_id,
+                  'img_shape': self.img_shape,
+                  'vector_shape': list(self.vector_shape),
+                  'dtype': self.dtype.str}
+        if augmentation is not None:
+            params['augmentation'] = augmentation
+        self.store_name = "features_" + hashlib.sha256(repr(sorted(params.items())).encode('UTF-8')).hexdigest()[0:16]
+        self.store = ArrayStore(os.path.join(directory, self.store_name), self.vector_shape, self.dtype,
+                                description=params)
+
+    def vectors(self, images, predict_fn):
+        """
+        Returns the vectors of the images of a dataset, calculating those that are not in the store
+        :param images: The (loaded) ImageDataset
+        :param predict_fn: Function that calculates the head vectors of the images at the given indices
+        :return: Read-only view of the vector of each image
+        """
+        return self.update(image_keys(images.data), predict_fn)
+
+    def views(self, images, predict_fn, num_views):
+        """
+        Returns augmented views of the images of a dataset, calculating those that are not in the store
+        :param images: The (loaded) ImageDataset
+        :param predict_fn: Function that calculates the head vectors of randomly augmented copies of the images at
+        the given indices
+        :param num_views: Number of views of each image
+        :return: Array of shape (number of images, num_views, *vector_shape)
+        """
+        keys = image_keys(images.data)
+        views = np.zeros((len(keys), num_views) + self.vector_shape, dtype=self.dtype)
+        for view in range(num_views):
+            print("- view {} of {}".format(view + 1, num_views))
+            views[:, view] = self.update(["{}|view{}".format(key, view) for key in keys], predict_fn)
+        return views
+
+    def update(self, keys, predict_fn):
+        """
+        Calculates the vectors for the keys that are not in the store
+        :return: Read-only view of the vector of each key
+        """
+        rows = self.store.lookup(keys)
+        # Identical images are only calculated once
+        missing = dict()
+        for idx in np.where(rows < 0)[0]:
+            missing.setdefault(keys[idx], idx)
+        print("- {} of {} vectors already in cache, {} to calculate".format(
+            np.count_nonzero(rows >= 0), len(keys), len(missing)))
+        if len(missing) > 0:
+            if self.cache_manager is not None:
+                self.cache_manager.evict(extra=len(missing) * self.store.row_bytes, keep=[self.store_name])
+            idxs = np.asarray(list(missing.values()), dtype=np.int64)
+            vectors = predict_fn(idxs)
+            start = self.store.allocate(list(missing.keys()))
+            data = self.store.open_data(start, len(missing))
+            data[:] = vectors
+            data.flush()
+            done = self.store.open_done(start, len(missing))
+            done[:] = 1
+            done.flush()
+            del data, done
+            rows = self.store.lookup(keys)
+        if self.cache_manager is not None:
+            self.cache_manager.touch(self.store_name)
+        return self.store.view(rows)
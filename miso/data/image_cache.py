@@ -0,0 +1,256 @@
+"""
+Image cache
+
+Images are stored in a growable memmap, one row per image, indexed by a key identifying the source file (its real
+path, size and modification time, or a hash of its contents). There is one store per set of transform parameters,
+shared by all datasets. Loading a list of files only decodes the files that are not already in the store, and the
+dataset is returned as a view over the store rows.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from miso.utils.lock import FileLock
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(str(Path.home()), 'miso_cache')
+
+
+def file_key(filename, identity='stat'):
+    """
+    Key identifying a particular version of a file
+    :param filename: Path to the file
+    :param identity: 'stat' - key is made from the real path (symlinks resolved), size and modification time,
+    'content' - key is a hash of the file contents, so identical copies of a file share the same key
+    :return: String key
+    """
+    if identity == 'stat':
+        st = os.stat(filename)
+        return "{}|{}|{}".format(os.path.realpath(filename), st.st_size, st.st_mtime_ns)
+    elif identity == 'content':
+        h = hashlib.blake2b(digest_size=20)
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return "blake2b:" + h.hexdigest()
+    else:
+        raise ValueError("identity must be 'stat' or 'content'")
+
+
+class CacheView:
+    """
+    Read-only view of a subset of rows of an array, that behaves like an array of shape (len(rows), ...).
+    Used so that datasets can index into a cache without copying it.
+    """
+    def __init__(self, data, rows):
+        self.data = data
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.shape = (len(self.rows),) + tuple(data.shape[1:])
+        self.dtype = data.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            selected = self[item[0]]
+            if np.ndim(self.rows[item[0]]) == 0:
+                return selected[item[1:]]
+            return selected[(slice(None),) + item[1:]]
+        rows = self.rows[item]
+        if np.ndim(rows) == 0:
+            return self.data[rows]
+        # Read in row order for locality then restore the requested order
+        order = np.argsort(rows, kind='stable')
+        out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        out[order] = self.data[rows[order]]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[np.arange(len(self.rows))]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+
+class RowReader:
+    """
+    Picklable reader of the rows of an ArrayStore, for use as the read function of ParallelImageLoader
+    """
+    def __init__(self, data_file, count, item_shape, dtype):
+        self.data_file = data_file
+        self.count = count
+        self.item_shape = item_shape
+        self.dtype = dtype
+        self.data = None
+
+    def __call__(self, row):
+        if self.data is None:
+            self.data = np.memmap(self.data_file, dtype=self.dtype, mode='r', shape=(self.count,) + self.item_shape)
+        return np.array(self.data[row])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+
+class ArrayStore:
+    """
+    Growable on-disk array of fixed shape items indexed by string keys.
+
+    The directory contains:
+    - data.bin: raw array of shape (count, *item_shape)
+    - done.bin: one byte per row, non-zero once the row has been written
+    - index.json: description, item shape, dtype, row count and the key to row mapping
+    - lock: lock file held while the index is read and updated, and while new rows are being written
+
+    Rows are only ever appended. A key that is allocated but whose row was never completed (e.g. the load was
+    interrupted) is allocated a new row the next time it is requested.
+
+    The store can be shared by several processes (e.g. training runs of a parameter sweep). The index is reloaded under
+    the lock whenever it has been changed by another process. A process adding items must hold the lock from lookup
+    until the new rows are marked as done, otherwise another process sees those rows as incomplete and allocates the
+    same keys again.
+    """
+    def __init__(self, directory, item_shape, dtype=np.uint8, description=None):
+        self.directory = directory
+        self.description = description
+        self.item_shape = tuple(int(v) for v in item_shape)
+        self.dtype = np.dtype(dtype)
+        self.data_file = os.path.join(directory, "data.bin")
+        self.done_file = os.path.join(directory, "done.bin")
+        self.index_file = os.path.join(directory, "index.json")
+        self.count = 0
+        self.index = dict()
+        self.index_mtime = None
+        os.makedirs(directory, exist_ok=True)
+        self.lock = FileLock(os.path.join(directory, "lock"))
+        with self.lock:
+            for filename in [self.data_file, self.done_file]:
+                if not os.path.exists(filename):
+                    open(filename, 'wb').close()
+            self.load()
+
+    def load(self):
+        """
+        Reads the index if it has changed since it was last read or saved. Call with the lock held.
+        """
+        if not os.path.exists(self.index_file):
+            return
+        # The index is replaced on each save, so a new file or modification time means it has changed
+        st = os.stat(self.index_file)
+        mtime = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if mtime == self.index_mtime:
+            return
+        with open(self.index_file, 'r') as f:
+            info = json.load(f)
+        if tuple(info['item_shape']) != self.item_shape or np.dtype(info['dtype']) != self.dtype:
+            raise ValueError("Store at {} has item shape {} and dtype {}, not {} and {}".format(
+                self.directory, info['item_shape'], info['dtype'], self.item_shape, self.dtype))
+        self.count = info['count']
+        self.index = info['index']
+        self.description = info.get('description', self.description)
+        self.index_mtime = mtime
+
+    @property
+    def row_bytes(self):
+        return int(np.prod(self.item_shape)) * self.dtype.itemsize
+
+    def save(self):
+        """
+        Writes the index. Call with the lock held.
+        """
+        info = {'description': self.description,
+                'item_shape': self.item_shape,
+                'dtype': self.dtype.str,
+                'count': self.count,
+                'index': self.index}
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp_file, self.index_file)
+        st = os.stat(self.index_file)
+        self.index_mtime = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def open_data(self, start=0, count=None, mode='r+'):
+        """
+        Memory maps rows [start, start + count) of the data
+        """
+        if count is None:
+            count = self.count - start
+        return np.memmap(self.data_file, dtype=self.dtype, mode=mode,
+                         offset=start * self.row_bytes, shape=(count,) + self.item_shape)
+
+    def open_done(self, start=0, count=None, mode='r+'):
+        """
+        Memory maps the completion flags of rows [start, start + count)
+        """
+        if count is None:
+            count = self.count - start
+        return np.memmap(self.done_file, dtype=np.uint8, mode=mode, offset=start, shape=(count,))
+
+    def lookup(self, keys):
+        """
+        Finds the rows of completed items
+        :param keys: List of keys
+        :return: Array of row indices, -1 where the key is not in the store or its row is not complete
+        """
+        with self.lock:
+            self.load()
+            rows = np.asarray([self.index.get(key, -1) for key in keys], dtype=np.int64)
+            rows[~self.complete(rows)] = -1
+        return rows
+
+    def complete(self, rows):
+        """
+        Whether each row exists and has been marked as done
+        :param rows: Array of row indices, negative for no row
+        :return: Boolean array
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        result = np.zeros(len(rows), dtype=bool)
+        valid = (rows >= 0) & (rows < self.count)
+        if np.any(valid):
+            done = self.open_done(mode='r')
+            result[valid] = done[rows[valid]] > 0
+            del done
+        return result
+
+    def allocate(self, keys):
+        """
+        Appends a new row for each key. The rows must then be written and marked as done.
+        :param keys: List of unique keys
+        :return: Index of the first new row
+        """
+        with self.lock:
+            # Another process may have added rows
+            self.load()
+            start = self.count
+            if len(keys) == 0:
+                return start
+            self.count += len(keys)
+            # Opening with a larger shape extends the files
+            self.open_data(start, len(keys), mode='r+').flush()
+            self.open_done(start, len(keys), mode='r+').flush()
+            for i, key in enumerate(keys):
+                self.index[key] = start + i
+            self.save()
+        return start
+
+    def reader(self):
+        """
+        Picklable function that reads a row of the store
+        """
+        return RowReader(self.data_file, self.count, self.item_shape, self.dtype)
+
+    def view(self, rows):
+        """
+        Read-only view of the given rows
+        """
+        if self.count == 0:
+            return CacheView(np.zeros((0,) + self.item_shape, dtype=self.dtype), rows)
+        return CacheView(self.open_data(mode='r'), rows)
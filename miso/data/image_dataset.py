@@ -1,12 +1,27 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
 import numpy as np
-import skimage.io as skio
 
+from miso.data.cache_manager import CacheManager
 from miso.data.dataset import DatasetBase
+from miso.data.image_cache import ArrayStore, file_key, DEFAULT_CACHE_DIRECTORY
 from miso.data.image_loader import ParallelImageLoader
-from miso.data.image_utils import resize_transform, resize_with_pad_transform, null_transform
+from miso.data.lazy_array import LazyImageArray
+from miso.data.image_utils import resize_transform, resize_with_pad_transform, null_transform, \
+    resize_fast_transform, resize_with_pad_fast_transform, read_image, read_image_shape, ImageReader
 from miso.data.tf_generator import TFGenerator
 
 
+# Resize transforms: (padding, backend)
+RESIZE_TRANSFORMS = {resize_transform: ('none', 'skimage'),
+                     resize_with_pad_transform: ('median', 'skimage'),
+                     resize_fast_transform: ('none', 'fast'),
+                     resize_with_pad_fast_transform: ('median', 'fast')}
+
+
 class ImageDataset(DatasetBase):
     def __init__(self,
                  filenames,
@@ -17,57 +32,291 @@ class ImageDataset(DatasetBase):
                  memmap_directory=None,
                  overwrite_memmap=False,
                  unique_id=None,
-                 dtype=np.uint8):
+                 dtype=np.uint8,
+                 loader_backend='process',
+                 incremental=False,
+                 file_identity='stat',
+                 cache_quota=None,
+                 pyramid=None,
+                 lazy=False,
+                 lazy_cache_size="4G",
+                 decoder='skimage',
+                 output_channels=None,
+                 pipeline='generator'):
+        """
+        Dataset of images loaded from a list of files into an array (in RAM or memory mapped on disk)
+        :param filenames: List of image filenames
+        :param cls: Class label of each image
+        :param transform_fn: Function applied to each image after loading, or 'resize' / 'resize_with_pad', or
+        'resize_fast' / 'resize_with_pad_fast' to resize uint8 and uint16 images without converting to float
+        :param transform_args: Extra arguments for the transform function
+        :param img_size: Size of the transformed images, if None the first image is loaded to find it
+        :param memmap_directory: Directory to store the memory mapped images, if None the images are stored in RAM
+        :param overwrite_memmap: Recreate the memory mapped images even if they already exist
+        :param unique_id: Extra identifier added to the hash of the dataset
+        :param dtype: Data type of the stored images
+        :param loader_backend: 'process' or 'thread' workers for loading the images
+        :param incremental: Store the images in a cache shared by all datasets, in the memmap directory or in
+        DEFAULT_CACHE_DIRECTORY if it is not set. There is one cache per set of transform parameters, indexed per file.
+        Only files that are not in the cache are loaded, and the data is a view over the cache.
+        :param file_identity: How files are identified in the cache, 'stat' (real path, size and modification time)
+        or 'content' (hash of the file contents, slower as every file must be read)
+        :param cache_quota: If not None, the memmap / cache directory is managed: memmap files are kept for reuse and
+        the least recently used entries are deleted to keep it under this size in bytes (or a string such as "50G")
+        :param pyramid: List of image sizes, e.g. [(64, 64), (128, 128), (224, 224)], to cache together. The images
+        are decoded once at the largest size, and the other sizes are created from the cached images, so that any of
+        the sizes can later be loaded without reading the image files. Uses the incremental cache. The number of
+        channels is taken from img_size.
+        :param lazy: Do not load the images up front, instead decode them when they are first accessed and keep them
+        in a cache of at most lazy_cache_size bytes. Use for datasets that do not fit in RAM or on disk.
+        :param lazy_cache_size: Maximum size of the lazy decode cache in bytes (or a string such as "4G")
+        :param decoder: 'skimage' or 'pillow'. With 'pillow' and a resize transform, large JPEG images are decoded at a
+        reduced resolution, which is much faster
+        :param output_channels: Number of channels of the images output by the generators, if different to the stored
+        images, e.g. 3 for greyscale images stored with one channel used with a three channel model
+        :param pipeline: Type of tf.data pipeline used by the generators, 'generator' or 'index' (see TFGenerator)
+        """
         self.filenames = filenames
         self.cls = cls
         self.transform_fn = transform_fn
         self.transform_args = transform_args
         self.unique_id = unique_id
+        self.loader_backend = loader_backend
+        self.incremental = incremental
+        self.file_identity = file_identity
+        self.store = None
+        self.store_names = []
+        self.lazy = lazy
+        self.lazy_cache_size = lazy_cache_size
+        self.decoder = decoder
+        self.output_channels = output_channels
+        self.pipeline = pipeline
 
         # Pre-made transforms
         if self.transform_fn == 'resize':
             self.transform_fn = resize_transform
         elif self.transform_fn == 'resize_with_pad':
             self.transform_fn = resize_with_pad_transform
+        elif self.transform_fn == 'resize_fast':
+            self.transform_fn = resize_fast_transform
+        elif self.transform_fn == 'resize_with_pad_fast':
+            self.transform_fn = resize_with_pad_fast_transform
 
         if self.transform_fn is None:
             self.transform_fn = null_transform
             self.transform_args = [0]
 
-        # Get dataset unique identification hash
-        super().__init__(memmap_directory=memmap_directory, overwrite_memmap=overwrite_memmap, dtype=dtype)
-        self.hash_data = ["ImageDataset", self.filenames, str(self.dtype), self.unique_id]
+        super().__init__(memmap_directory=memmap_directory, overwrite_memmap=overwrite_memmap, dtype=dtype, cache_quota=cache_quota)
 
         print('-' * 80)
         print("Loading images")
-        print("- id: {}".format(self.get_hash_id()))
-        if memmap_directory is None:
-            print("- stored in RAM")
-        else:
-            print("- stored on disk at {}".format(self.memmap_file))
 
-        if img_size is None:
+        if img_size is None and self.transform_fn in RESIZE_TRANSFORMS:
+            self.img_size = tuple(self.transform_args[0])
+        elif img_size is None and self.transform_fn is null_transform:
+            # Read the size from the header of the first image
+            self.img_size = tuple(read_image_shape(self.filenames[0]))
+        elif img_size is None:
             # Read first image to see the size
-            im = skio.imread(self.filenames[0])
+            im = read_image(self.filenames[0], self.decoder)
             if self.transform_args is not None:
                 im = self.transform_fn(im, *self.transform_args)
             else:
                 im = self.transform_fn(im)
             self.img_size = im.shape
         else:
-            self.img_size = img_size
+            self.img_size = tuple(img_size)
         self.arr_size = (len(self.filenames),) + self.img_size
+
+        # Pyramid sizes, largest first
+        self.pyramid = None
+        if pyramid is not None:
+            if self.transform_fn not in RESIZE_TRANSFORMS:
+                raise ValueError("A pyramid cache can only be used with the resize transforms")
+            sizes = set(tuple(int(v) for v in size[:2]) + self.img_size[2:] for size in pyramid)
+            sizes.add(self.img_size)
+            self.pyramid = sorted(sizes, key=lambda size: size[0] * size[1], reverse=True)
+            self.incremental = True
+
+        # Get dataset unique identification hash
+        self.hash_data = ["ImageDataset", self.filenames, str(self.dtype), self.unique_id, self.get_transform_params()]
+        print("- id: {}".format(self.get_hash_id()))
+        if self.lazy and self.incremental:
+            raise ValueError("A lazy dataset cannot use the incremental image cache")
+        if self.lazy:
+            print("- loaded on demand (cache size {})".format(self.lazy_cache_size))
+        elif self.incremental:
+            print("- stored in image cache")
+        elif memmap_directory is None:
+            print("- stored in RAM")
+        else:
+            print("- stored on disk at {}".format(os.path.join(memmap_directory, self.get_hash_id() + ".npy")))
         print("Array size is {}".format(self.arr_size))
 
+    def get_transform_params(self, img_size=None):
+        """
+        Parameters that determine the stored image for a given file
+        :param img_size: Output image size, if None the dataset image size is used
+        :return: Dictionary of transform parameters
+        """
+        if img_size is None:
+            img_size = self.img_size
+        params = OrderedDict()
+        if self.transform_fn in RESIZE_TRANSFORMS:
+            args = list(self.transform_args) + [False] * (2 - len(self.transform_args))
+            pad, backend = RESIZE_TRANSFORMS[self.transform_fn]
+            params['transform'] = 'resize'
+            params['shape'] = [int(v) for v in img_size]
+            params['greyscale'] = bool(args[1])
+            params['pad'] = pad
+            # Only added for other backends so that existing caches keep their ids
+            if backend != 'skimage':
+                params['backend'] = backend
+            if self.decoder != 'skimage':
+                params['decoder'] = self.decoder
+        else:
+            params['transform'] = self.transform_fn.__name__
+            params['args'] = repr(self.transform_args)
+        params['img_size'] = [int(v) for v in img_size]
+        params['dtype'] = np.dtype(self.dtype).str
+        return params
+
+    def get_reader(self, img_size=None):
+        """
+        Function used to read the image files, None for the default (skimage.io.imread)
+        :param img_size: Size the images will be resized to, if None the dataset image size is used
+        """
+        if self.decoder == 'skimage':
+            return None
+        if img_size is None:
+            img_size = self.img_size
+        if self.transform_fn not in RESIZE_TRANSFORMS:
+            img_size = None
+        return ImageReader(self.decoder, img_size)
+
+    @staticmethod
+    def get_transform_hash_id(params):
+        """
+        Creates a 16 character hash id from the transform parameters, used to identify the image cache
+        :return: 16 character hash id
+        """
+        return hashlib.sha256(json.dumps(params).encode('UTF-8')).hexdigest()[0:16]
+
     def load(self):
+        if self.lazy:
+            self.data = LazyImageArray(self.filenames,
+                                       self.img_size,
+                                       transform_fn=self.transform_fn,
+                                       transform_args=self.transform_args,
+                                       dtype=self.dtype,
+                                       cache_size=self.lazy_cache_size,
+                                       read_fn=self.get_reader())
+            return
+        if self.incremental:
+            self.load_incremental()
+            return
         if self.read_or_create_data(self.arr_size, self.dtype) is not True:
             loader = ParallelImageLoader(self.filenames,
                                          self.data,
                                          transform_fn=self.transform_fn,
-                                         transform_args=self.transform_args)
+                                         transform_args=self.transform_args,
+                                         backend=self.loader_backend,
+                                         completion=self.completion,
+                                         read_fn=self.get_reader())
             loader.load()
+            self.update_cache()
+
+    def load_incremental(self):
+        """
+        Loads the images that are not already in the image cache, then sets the data to a view over the cache.
+        If a pyramid is used, the images are cached at the largest pyramid size and the other sizes are created by
+        resizing the cached images.
+        """
+        if self.memmap_directory is None:
+            cache_directory = DEFAULT_CACHE_DIRECTORY
+        else:
+            cache_directory = self.memmap_directory
+        if self.cache_quota is not None:
+            self.cache_manager = CacheManager(cache_directory, self.cache_quota)
+        keys = [file_key(filename, self.file_identity) for filename in self.filenames]
+        self.store_names = []
+        print("- cache at {}".format(cache_directory))
+
+        if self.pyramid is None:
+            params = self.get_transform_params()
+            self.store, rows = self.update_store(cache_directory, params, keys, self.filenames,
+                                                 read_fn=self.get_reader())
+        else:
+            # Base level is loaded from the files
+            base_params = self.get_transform_params(self.pyramid[0])
+            print("- pyramid level {}".format(self.pyramid[0]))
+            base_store, base_rows = self.update_store(cache_directory, base_params, keys, self.filenames,
+                                                      transform_args=[self.pyramid[0]] + list(self.transform_args[1:]),
+                                                      read_fn=self.get_reader(self.pyramid[0]))
+            self.store, rows = base_store, base_rows
+            # Other levels are resized from the base level, using the base rows that update_store verified as complete
+            for img_size in self.pyramid[1:]:
+                params = self.get_transform_params(img_size)
+                params['derived_from'] = base_params['img_size']
+                print("- pyramid level {}".format(img_size))
+                store, level_rows = self.update_store(cache_directory, params, keys, base_rows,
+                                                      transform_args=[img_size, False],
+                                                      read_fn=base_store.reader())
+                if img_size == self.img_size:
+                    self.store, rows = store, level_rows
+        self.data = self.store.view(rows)
+
+    def update_store(self, cache_directory, params, keys, sources, transform_args=None, read_fn=None):
+        """
+        Opens the store for the given transform parameters and loads any missing images into it
+        :param cache_directory: Directory containing the stores
+        :param params: Transform parameters, from get_transform_params
+        :param keys: Key of each image
+        :param sources: Source of each image (filename, or row of another store read using read_fn)
+        :param transform_args: Transform arguments, if None the dataset transform arguments are used
+        :param read_fn: Function to read the source, if None the images are read from file using skimage
+        :return: The store, and the store row of each image
+        """
+        store_name = "images_" + self.get_transform_hash_id(params)
+        self.store_names.append(store_name)
+        store = ArrayStore(os.path.join(cache_directory, store_name), params['img_size'], self.dtype, description=params)
+        # Hold the store lock until the new rows are done, so that another process does not see them as missing and
+        # allocate the same images again
+        with store.lock:
+            rows = store.lookup(keys)
+            missing = np.where(rows < 0)[0]
+            key_sources = OrderedDict((keys[i], sources[i]) for i in missing)
+            print("- {} of {} images already in cache, {} to load".format(len(keys) - len(missing), len(keys), len(key_sources)))
+            if len(key_sources) > 0:
+                if self.cache_manager is not None:
+                    self.cache_manager.evict(extra=len(key_sources) * store.row_bytes, keep=self.store_names)
+                start = store.allocate(list(key_sources.keys()))
+                loader = ParallelImageLoader(list(key_sources.values()),
+                                             store.open_data(start, len(key_sources)),
+                                             transform_fn=self.transform_fn,
+                                             transform_args=self.transform_args if transform_args is None else transform_args,
+                                             backend=self.loader_backend,
+                                             completion=store.open_done(start, len(key_sources)),
+                                             read_fn=read_fn)
+                loader.load()
+                # Rows allocated by this process (identical images share a key and a row)
+                new_rows = {key: start + i for i, key in enumerate(key_sources.keys())}
+                rows[missing] = [new_rows[keys[i]] for i in missing]
+            assert np.all(rows >= 0)
+            # Every image must have a complete row, e.g. pyramid levels are made from these rows
+            if not np.all(store.complete(rows)):
+                raise RuntimeError("{} of {} images in the cache at {} are not complete".format(
+                    np.count_nonzero(~store.complete(rows)), len(rows), store.directory))
+        if self.cache_manager is not None:
+            self.cache_manager.touch(store_name)
+        return store, rows
+
+    def release(self):
+        if self.lazy and self.data is not None:
+            self.data.close()
+        super().release()
 
-    def create_generator(self, batch_size, idxs=None, map_fn=TFGenerator.map_fn_divide_255, shuffle=True, one_shot=False, undersample=False):
+    def create_generator(self, batch_size, idxs=None, map_fn=TFGenerator.map_fn_divide_255, shuffle=True, one_shot=False, undersample=False, random_seed=None):
         # Create generators for training
         gen = TFGenerator(self.data,
                           self.cls,
@@ -76,5 +325,8 @@ class ImageDataset(DatasetBase):
                           map_fn=map_fn,
                           shuffle=shuffle,
                           one_shot=one_shot,
-                          undersample=undersample)
+                          undersample=undersample,
+                          output_channels=self.output_channels,
+                          pipeline=self.pipeline,
+                          random_seed=random_seed)
         return gen
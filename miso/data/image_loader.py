@@ -1,8 +1,20 @@
+import mmap
+import queue
+import threading
+import time
 from multiprocessing import Process, cpu_count, Queue
 import skimage.io as skio
 import numpy as np
 from tqdm import tqdm
 
+from miso.data.image_utils import read_image_shape
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
 
 def produce(producer_queue, data, workers):
     for datum in data:
@@ -10,68 +22,380 @@ def produce(producer_queue, data, workers):
     [producer_queue.put(None) for i in range(workers)]
 
 
-def work(producer_queue, consumer_queue, transform_fn, transform_args):
+def load(filename, transform_fn, transform_args, read_fn=None):
+    if read_fn is None:
+        im = skio.imread(filename)
+    else:
+        im = read_fn(filename)
+    if transform_fn is not None:
+        if transform_args is not None:
+            im = transform_fn(im, *transform_args)
+        else:
+            im = transform_fn(im)
+    return im
+
+
+def make_chunks(idxs, chunk_size):
+    """
+    Splits a sorted array of indices into contiguous (start, end) chunks of at most chunk_size indices
+    """
+    chunks = []
+    if len(idxs) == 0:
+        return chunks
+    breaks = np.where(np.diff(idxs) != 1)[0] + 1
+    for run in np.split(idxs, breaks):
+        for i in range(0, len(run), chunk_size):
+            chunks.append((int(run[i]), int(run[min(i + chunk_size, len(run)) - 1]) + 1))
+    return chunks
+
+
+def work(producer_queue, consumer_queue, filenames, transform_fn, transform_args, read_fn):
     while True:
         res = producer_queue.get()
         if res is None:
             consumer_queue.put(None)
             break
-        im = skio.imread(res[1])
-        if transform_fn is not None:
-            if transform_args is not None:
-                im = transform_fn(im, *transform_args)
-            else:
-                im = transform_fn(im)
-        consumer_queue.put((res[0], im))
+        start, end = res
+        ims = [load(filenames[i], transform_fn, transform_args, read_fn) for i in range(start, end)]
+        consumer_queue.put((start, end, ims))
+
+
+def work_shared(producer_queue, consumer_queue, filenames, target, multiplier, transform_fn, transform_args, read_fn):
+    """
+    Worker that writes each decoded image directly into the shared target array.
+    Only the index range of each completed chunk is sent back to the parent.
+    """
+    array = target.attach()
+    try:
+        while True:
+            res = producer_queue.get()
+            if res is None:
+                consumer_queue.put(None)
+                break
+            start, end = res
+            for i in range(start, end):
+                array[i*multiplier:(i+1)*multiplier] = load(filenames[i], transform_fn, transform_args, read_fn)
+            consumer_queue.put((start, end))
+    finally:
+        del array
+        target.detach()
+
+
+def consume(consumer_queue, array, multiplier, num_workers, on_complete):
+    while num_workers > 0:
+        res = consumer_queue.get()
+        if res is None:
+            num_workers -= 1
+            continue
+        start, end, ims = res
+        for i, im in zip(range(start, end), ims):
+            array[i*multiplier:(i+1)*multiplier] = im
+        on_complete(start, end)
 
 
-def consume(consumer_queue, array, multiplier, num_workers):
-    pbar = tqdm(total=len(array))
+def consume_shared(consumer_queue, num_workers, on_complete):
     while num_workers > 0:
         res = consumer_queue.get()
         if res is None:
             num_workers -= 1
             continue
-        array[res[0]*multiplier:(res[0]+1)*multiplier] = res[1]
-        pbar.update(multiplier)
-    pbar.close()
+        start, end = res
+        on_complete(start, end)
 
 
 def get_array_shape(filenames):
-    im = skio.imread(filenames[0])
-    return (len(filenames),) + im.shape
+    return (len(filenames),) + tuple(read_image_shape(filenames[0]))
+
+
+def is_file_memmap(array):
+    """
+    True if the array is a numpy memmap that owns its file mapping (i.e. not a view into a memmap)
+    """
+    return isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename is not None
+
+
+class ArrayTarget:
+    """
+    Target for worker threads, which can write into the array directly
+    """
+    def __init__(self, array):
+        self.array = array
+
+    def attach(self):
+        return self.array
+
+    def detach(self):
+        pass
+
+
+class MemmapTarget:
+    """
+    Picklable description of a memmap file that worker processes can attach to and write into
+    """
+    def __init__(self, array):
+        self.filename = array.filename
+        self.offset = array.offset
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.array = None
+
+    def attach(self):
+        self.array = np.memmap(self.filename, dtype=self.dtype, mode='r+', offset=self.offset, shape=self.shape)
+        return self.array
+
+    def detach(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['array'] = None
+        return state
+
+
+class SharedMemoryTarget:
+    """
+    Block of shared memory that worker processes can attach to and write into.
+    Used when the destination array is in RAM.
+    """
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.name = self.shm.name
+        self.owner = True
+
+    def attach(self):
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def detach(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def release(self):
+        self.detach()
+        if self.owner:
+            shared_memory.SharedMemory(name=self.name).unlink()
+            self.owner = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = None
+        state['owner'] = False
+        return state
 
 
 class ParallelImageLoader:
-    def __init__(self, filenames, array, multiplier=1, transform_fn=None, transform_args=None):
+    # Calibration settings used when the number of workers or chunk size is not given
+    CALIBRATION_COUNT = 8
+    TARGET_CHUNK_TIME = 0.05
+    MIN_WORKER_TIME = 0.5
+    MAX_CHUNK_SIZE = 256
+    # Seconds between flushes of the completion bitmap to disk
+    FLUSH_INTERVAL = 5
+
+    def __init__(self,
+                 filenames,
+                 array,
+                 multiplier=1,
+                 transform_fn=None,
+                 transform_args=None,
+                 mode='shared',
+                 backend='process',
+                 num_workers=None,
+                 chunk_size=None,
+                 completion=None,
+                 read_fn=None):
+        """
+        Loads a list of images in parallel into an array
+        :param filenames: Filenames of the images to load
+        :param array: Destination array (numpy array or memmap), first dimension indexes the images
+        :param multiplier: Number of rows in the array taken by each image
+        :param transform_fn: Function applied to each image after loading
+        :param transform_args: Extra arguments for the transform function
+        :param mode: 'shared' - workers write directly into the memmap file, or into a shared memory block that is
+        copied into the array at the end, only indices are sent back to the parent process.
+        'queue' - workers send each image back through a queue to be copied into the array by the parent process
+        :param backend: 'process' - use worker processes, 'thread' - use worker threads that write into the array
+        directly (faster when the decoder releases the GIL)
+        :param num_workers: Number of workers, if None it is chosen automatically using a short calibration run
+        :param chunk_size: Number of images sent to a worker at a time, if None it is chosen automatically
+        :param completion: Completion bitmap (array or memmap of length len(filenames)), non-zero entries are already
+        loaded and are skipped. Entries are set as each image is written to the array. If None, all images are loaded.
+        :param read_fn: Function that reads an image given an entry of filenames, if None skimage.io.imread is used.
+        Must be picklable for the process backend.
+        """
+        if mode not in ('shared', 'queue'):
+            raise ValueError("mode must be 'shared' or 'queue'")
+        if backend not in ('process', 'thread'):
+            raise ValueError("backend must be 'process' or 'thread'")
         self.filenames = filenames
         self.array = array
         self.transform_fn = transform_fn
         self.transform_args = transform_args
         self.multiplier = multiplier
+        self.mode = mode
+        self.backend = backend
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        if completion is None:
+            completion = np.zeros(len(filenames), dtype=np.uint8)
+        self.completion = completion
+        self.read_fn = read_fn
+        if self.backend == 'thread':
+            self.mode = 'shared'
+        elif self.mode == 'shared' and shared_memory is None and not is_file_memmap(self.array):
+            self.mode = 'queue'
 
-        self.producer_queue = Queue()
-        self.consumer_queue = Queue(cpu_count() * 4)
+        self.producer_queue = None
+        self.consumer_queue = None
         self.workers = None
-        self.NUMBER_OF_PROCESSES = cpu_count()
+        self.pbar = None
+        self.completed_chunks = []
+        self.last_flush = None
+
+    def on_complete(self, start, end):
+        """
+        Called when the images with indices [start, end) have been written
+        """
+        self.completion[start:end] = 1
+        self.completed_chunks.append((start, end))
+        self.pbar.update(end - start)
+        if is_file_memmap(self.completion) and time.time() - self.last_flush > self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        # Data first, so that the bitmap never marks an image that is not on disk
+        if is_file_memmap(self.array):
+            self.array.flush()
+        if is_file_memmap(self.completion):
+            self.completion.flush()
+        self.last_flush = time.time()
+
+    def calibrate(self, idxs):
+        """
+        Loads the first few images in this process to measure the time per image, then chooses the number of
+        workers and chunk size so that each chunk takes roughly TARGET_CHUNK_TIME and each worker has at least
+        MIN_WORKER_TIME of work.
+        :param idxs: Indices of the images to load
+        :return: Number of images loaded during calibration
+        """
+        count = 0
+        elapsed = 0
+        if self.num_workers is None or self.chunk_size is None:
+            count = min(self.CALIBRATION_COUNT, len(idxs))
+            start = time.time()
+            for i in idxs[:count]:
+                self.array[i*self.multiplier:(i+1)*self.multiplier] = load(self.filenames[i],
+                                                                           self.transform_fn,
+                                                                           self.transform_args,
+                                                                           self.read_fn)
+                self.on_complete(i, i + 1)
+            elapsed = time.time() - start
+        time_per_image = elapsed / max(count, 1)
+        remaining = len(idxs) - count
+        if self.chunk_size is None:
+            self.chunk_size = int(np.clip(self.TARGET_CHUNK_TIME / max(time_per_image, 1e-6), 1, self.MAX_CHUNK_SIZE))
+        if self.num_workers is None:
+            num_workers = int(remaining * time_per_image / self.MIN_WORKER_TIME)
+            num_chunks = int(np.ceil(remaining / self.chunk_size))
+            self.num_workers = int(np.clip(num_workers, 1, max(min(cpu_count(), num_chunks), 1)))
+        print("- {} backend, {} mode, {} workers, chunk size {} ({:.2f}ms per image)".format(
+            self.backend, self.mode, self.num_workers, self.chunk_size, time_per_image * 1000))
+        return count
 
     def load(self):
-        print("Starting queue with {} workers".format(self.NUMBER_OF_PROCESSES))
-        payload = zip(range(len(self.filenames)), self.filenames)
-        self.workers = [
-            Process(target=work, args=(self.producer_queue, self.consumer_queue, self.transform_fn, self.transform_args), name='producer {}'.format(i)) for i in
-            range(self.NUMBER_OF_PROCESSES)]
+        idxs = np.where(np.asarray(self.completion) == 0)[0]
+        if len(idxs) < len(self.filenames):
+            print("- resuming, {} of {} images already loaded".format(len(self.filenames) - len(idxs), len(self.filenames)))
+        self.pbar = tqdm(total=len(idxs))
+        self.last_flush = time.time()
+        start_time = time.time()
+        try:
+            count = self.calibrate(idxs)
+            # Images loaded during calibration were written to the array directly
+            self.completed_chunks = []
+            chunks = make_chunks(idxs[count:], self.chunk_size)
+            if len(chunks) > 0:
+                if self.backend == 'thread':
+                    self._load_threads(chunks)
+                else:
+                    self._load_processes(chunks)
+        finally:
+            self.flush()
+            self.pbar.close()
+        elapsed = time.time() - start_time
+        print("- loaded {} images in {:.1f}s ({:.1f} images/sec)".format(
+            len(idxs), elapsed, len(idxs) / max(elapsed, 1e-6)))
+
+    def _load_threads(self, chunks):
+        self.producer_queue = queue.Queue()
+        self.consumer_queue = queue.Queue()
+        target = ArrayTarget(self.array)
+        args = (self.producer_queue, self.consumer_queue, self.filenames, target, self.multiplier, self.transform_fn, self.transform_args, self.read_fn)
+        self.workers = [threading.Thread(target=work_shared, args=args, name='producer {}'.format(i), daemon=True)
+                        for i in range(self.num_workers)]
         for w in self.workers:
             w.start()
         try:
-            produce(self.producer_queue, payload, self.NUMBER_OF_PROCESSES)
-            consume(self.consumer_queue, self.array, self.multiplier, self.NUMBER_OF_PROCESSES)
+            produce(self.producer_queue, chunks, self.num_workers)
+            consume_shared(self.consumer_queue, self.num_workers, self.on_complete)
         except KeyboardInterrupt:
             print("Keyboard interrupt...")
+            # Threads cannot be terminated, so drop the remaining work and let them finish their current chunk
+            try:
+                while True:
+                    self.producer_queue.get_nowait()
+            except queue.Empty:
+                pass
+            [self.producer_queue.put(None) for i in range(self.num_workers)]
+            raise
         finally:
             for w in self.workers:
-                w.terminate()
                 w.join()
-        self.producer_queue.close()
-        self.consumer_queue.close()
 
+    def _load_processes(self, chunks):
+        self.producer_queue = Queue()
+        self.consumer_queue = Queue(self.num_workers * 4)
+        target = None
+        if self.mode == 'shared':
+            if is_file_memmap(self.array):
+                target = MemmapTarget(self.array)
+            else:
+                target = SharedMemoryTarget(self.array.shape, self.array.dtype)
+            args = (self.producer_queue, self.consumer_queue, self.filenames, target, self.multiplier, self.transform_fn, self.transform_args, self.read_fn)
+            work_fn = work_shared
+        else:
+            args = (self.producer_queue, self.consumer_queue, self.filenames, self.transform_fn, self.transform_args, self.read_fn)
+            work_fn = work
+        self.workers = [Process(target=work_fn, args=args, name='producer {}'.format(i))
+                        for i in range(self.num_workers)]
+        for w in self.workers:
+            w.start()
+        try:
+            produce(self.producer_queue, chunks, self.num_workers)
+            if self.mode == 'shared':
+                consume_shared(self.consumer_queue, self.num_workers, self.on_complete)
+            else:
+                consume(self.consumer_queue, self.array, self.multiplier, self.num_workers, self.on_complete)
+        except KeyboardInterrupt:
+            print("Keyboard interrupt...")
+            raise
+        finally:
+            for w in self.workers:
+                w.terminate()
+                w.join()
+            if isinstance(target, SharedMemoryTarget):
+                # Copy the chunks that were completed by the workers
+                shared = target.attach()
+                for start, end in self.completed_chunks:
+                    self.array[start*self.multiplier:end*self.multiplier] = shared[start*self.multiplier:end*self.multiplier]
+                del shared
+                target.release()
+            self.producer_queue.close()
+            self.consumer_queue.close()
@@ -1,25 +1,122 @@
+from functools import lru_cache
+
 import numpy as np
 from skimage import io as skio, transform as skt, color as skc
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Decoding
+#
+# 'skimage' decodes the full image using skimage.io.imread.
+# 'pillow' decodes using Pillow. If the size the image will be resized to is known, JPEG images are decoded at a
+# reduced resolution (1/2, 1/4 or 1/8, by scaling in the DCT domain) that is still at least DRAFT_OVERSAMPLE times the
+# target size, which is much faster for large images. Files that Pillow cannot read are decoded using skimage.
+# ----------------------------------------------------------------------------------------------------------------------
+DECODERS = ('skimage', 'pillow')
+DRAFT_OVERSAMPLE = 2
+
+
+def read_image(filename, decoder='skimage', target_size=None):
+    """
+    Reads an image
+    :param filename: Filename of the image
+    :param decoder: 'skimage' or 'pillow'
+    :param target_size: Size (height, width, ...) the image will be resized to, or None if it will not be resized
+    :return: Image array
+    """
+    if decoder not in DECODERS:
+        raise ValueError("decoder must be one of {}".format(DECODERS))
+    if decoder == 'pillow' and Image is not None:
+        try:
+            return read_image_pillow(filename, target_size)
+        except OSError:
+            pass
+    return skio.imread(filename)
+
+
+def read_image_pillow(filename, target_size=None):
+    with Image.open(filename) as img:
+        if target_size is not None and img.format == 'JPEG':
+            img.draft(img.mode, (int(target_size[1]) * DRAFT_OVERSAMPLE, int(target_size[0]) * DRAFT_OVERSAMPLE))
+        if img.mode == 'P':
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        elif img.mode in ('1', 'CMYK', 'YCbCr', 'LAB', 'HSV'):
+            img = img.convert('L' if img.mode == '1' else 'RGB')
+        im = np.asarray(img)
+        # 16 bit images are uint16 as with skimage (older versions of pillow open 16 bit PNGs in mode 'I' (int32),
+        # and 'I;16B' is big-endian)
+        if img.mode.startswith('I;16') or (img.mode == 'I' and img.format == 'PNG'):
+            im = im.astype(np.uint16)
+        return im
+
+
+def read_image_shape(filename):
+    """
+    Shape of an image, read from the file header if possible
+    :param filename: Filename of the image
+    :return: (height, width) or (height, width, channels)
+    """
+    if Image is not None:
+        try:
+            with Image.open(filename) as img:
+                width, height = img.size
+                if img.mode == 'P':
+                    channels = 4 if 'transparency' in img.info else 3
+                elif img.mode in ('CMYK', 'YCbCr', 'LAB', 'HSV'):
+                    channels = 3
+                else:
+                    channels = len(img.getbands())
+        except OSError:
+            return skio.imread(filename).shape
+        return (height, width) if channels == 1 else (height, width, channels)
+    return skio.imread(filename).shape
+
+
+class ImageReader:
+    """
+    Picklable image reading function, for use as the read function of ParallelImageLoader
+    """
+    def __init__(self, decoder='skimage', target_size=None):
+        """
+        :param decoder: 'skimage' or 'pillow'
+        :param target_size: Size the images will be resized to, or None
+        """
+        self.decoder = decoder
+        self.target_size = target_size
+
+    def __call__(self, filename):
+        return read_image(filename, self.decoder, self.target_size)
+
 
-def load_image(filename, img_size=None, img_type='rgb'):
+def load_image(filename, img_size=None, img_type='rgb', decoder='skimage'):
     """
     Loads an image, converting it if necessary
     :param filename: Filename of image to load
     :param img_size: Size of image, e.g. (224, 224). If None, the image dimensions are preserved
     :param img_type: 'rgb' (colour) or 'k' (greyscale)
+    :param decoder: 'skimage' or 'pillow' (faster for large JPEG images)
     :return:
     """
     # Colour
     if img_type == 'rgb':
-        im = skio.imread(filename)
+        im = read_image(filename, decoder, img_size)
         # im = np.asarray(im, dtype=np.float)
         # If it was a single channel image, make into 3-channel
         if im.ndim == 2:
             im = np.repeat(im[..., np.newaxis], repeats=3, axis=-1)
     # Greyscale
     elif img_type == 'k' or img_type == 'greyscale':
-        im = skio.imread(filename, as_gray=True)
+        if decoder == 'skimage':
+            im = skio.imread(filename, as_gray=True)
+        else:
+            im = read_image(filename, decoder, img_size)
+            if im.ndim == 3:
+                im = skc.rgb2gray(im[..., :3])
         im = im[..., np.newaxis]
     else:
         raise ValueError("img_type must be 'rgb' or 'k'")
@@ -109,3 +206,140 @@ def resize_with_pad_transform(im, shape, to_greyscale=False):
 
 def null_transform(im, args):
     return im
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Fast transforms
+#
+# Pad and resize uint8 and uint16 images in their own data type, without converting to float64. Downsampling uses area
+# interpolation and upsampling uses bilinear interpolation. The output is uint8, as for the transforms above, but may
+# differ from them by a few grey levels as skimage uses gaussian anti-aliasing and truncates rather than rounds.
+# Images of other data types use the skimage transforms.
+# ----------------------------------------------------------------------------------------------------------------------
+FAST_DTYPES = (np.uint8, np.uint16)
+GREYSCALE_WEIGHTS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32)
+
+
+def pad_to_aspect(im, img_size):
+    """
+    Pads an image to the aspect ratio of img_size with the median of its border, in the image data type.
+    Same padding as resize_and_pad_image.
+    """
+    if np.ndim(im) == 2:
+        im = im[..., np.newaxis]
+    height, width = im.shape[:2]
+    desired_whratio = img_size[1] / img_size[0]
+    if np.round(height * desired_whratio) == width:
+        return im
+    if desired_whratio > width / height:
+        half = np.round(height * desired_whratio)
+        pad_start = int(abs(np.floor((width - half) / 2)))
+        out_shape = (height, width + pad_start + int(abs(np.ceil((width - half) / 2)))) + im.shape[2:]
+        region = (slice(None), slice(pad_start, pad_start + width))
+    else:
+        half = np.round(width / desired_whratio)
+        pad_start = int(abs(np.floor((height - half) / 2)))
+        out_shape = (height + pad_start + int(abs(np.ceil((height - half) / 2))), width) + im.shape[2:]
+        region = (slice(pad_start, pad_start + height), slice(None))
+    border = np.concatenate((im[0], im[-1], im[:, 0], im[:, -1]), axis=0)
+    consts = np.median(border, axis=0).astype(im.dtype)
+    out = np.empty(out_shape, dtype=im.dtype)
+    out[...] = consts
+    out[region] = im
+    return out
+
+
+@lru_cache(maxsize=64)
+def resize_weights(in_size, out_size):
+    """
+    Matrix of shape (out_size, in_size) that resizes a line of pixels, using area interpolation when shrinking and
+    bilinear interpolation when enlarging
+    """
+    if out_size <= in_size:
+        bounds = np.linspace(0, in_size, out_size + 1)
+        pixels = np.arange(in_size)
+        lo = np.maximum(bounds[:-1, np.newaxis], pixels[np.newaxis, :])
+        hi = np.minimum(bounds[1:, np.newaxis], pixels[np.newaxis, :] + 1)
+        weights = np.clip(hi - lo, 0, None) * (out_size / in_size)
+    else:
+        centres = np.clip((np.arange(out_size) + 0.5) * in_size / out_size - 0.5, 0, in_size - 1)
+        left = np.floor(centres).astype(int)
+        right = np.minimum(left + 1, in_size - 1)
+        frac = centres - left
+        weights = np.zeros((out_size, in_size))
+        np.add.at(weights, (np.arange(out_size), left), 1 - frac)
+        np.add.at(weights, (np.arange(out_size), right), frac)
+    return weights.astype(np.float32)
+
+
+def resize_native(im, img_size):
+    """
+    Resizes a uint8 or uint16 image (height, width, channels) keeping its data type.
+    uint8 images are resized using Pillow if available, otherwise (and for uint16) by separable weight matrices.
+    """
+    height, width = img_size[0], img_size[1]
+    if im.shape[0] == height and im.shape[1] == width:
+        return im
+    if im.dtype == np.uint8 and Image is not None:
+        shrink = height <= im.shape[0] and width <= im.shape[1]
+        resample = Image.BOX if shrink else Image.BILINEAR
+        if im.shape[2] == 3:
+            return np.asarray(Image.fromarray(im).resize((width, height), resample))
+        return np.stack([np.asarray(Image.fromarray(im[:, :, c]).resize((width, height), resample))
+                         for c in range(im.shape[2])], axis=2)
+    wy = resize_weights(im.shape[0], height)
+    wx = resize_weights(im.shape[1], width)
+    out = np.tensordot(wy, im.astype(np.float32), axes=(1, 0))
+    out = np.tensordot(out, wx, axes=(1, 1)).transpose(0, 2, 1)
+    return np.clip(np.round(out), 0, np.iinfo(im.dtype).max).astype(im.dtype)
+
+
+def to_channels_native(im, out_channels, to_greyscale=False):
+    """
+    As to_channels, but keeps the image data type and does not repeat single channel images (do this after resizing)
+    """
+    if np.ndim(im) == 2:
+        im = im[..., np.newaxis]
+    if im.shape[2] == 4:
+        im = im[:, :, :3]
+    if im.shape[2] == 3 and to_greyscale is True:
+        grey = np.tensordot(im.astype(np.float32), GREYSCALE_WEIGHTS, axes=(2, 0))
+        im = np.round(grey).astype(im.dtype)[..., np.newaxis]
+    elif im.shape[2] > 1 and out_channels == 1:
+        # skimage resize averages over the channel axis in this case
+        im = np.round(im.mean(axis=2, dtype=np.float32)).astype(im.dtype)[..., np.newaxis]
+    return im
+
+
+def repeat_channels(im, out_channels):
+    if im.shape[2] == 1 and out_channels == 3:
+        im = np.repeat(im, 3, axis=-1)
+    return im
+
+
+def to_uint8(im):
+    if im.dtype == np.uint16:
+        return np.round(im / 257).astype(np.uint8)
+    return im
+
+
+def resize_fast_transform(im, shape, to_greyscale=False):
+    """
+    Same as resize_transform, using the fast path for uint8 and uint16 images
+    """
+    if im.dtype not in FAST_DTYPES:
+        return resize_transform(im, shape, to_greyscale)
+    im = to_channels_native(im, shape[2], to_greyscale)
+    return repeat_channels(to_uint8(resize_native(im, shape)), shape[2])
+
+
+def resize_with_pad_fast_transform(im, shape, to_greyscale=False):
+    """
+    Same as resize_with_pad_transform, using the fast path for uint8 and uint16 images
+    """
+    if im.dtype not in FAST_DTYPES:
+        return resize_with_pad_transform(im, shape, to_greyscale)
+    im = to_channels_native(im, shape[2], to_greyscale)
+    if im.shape[0] != shape[0] or im.shape[1] != shape[1]:
+        im = resize_native(pad_to_aspect(im, shape), shape)
+    return repeat_channels(to_uint8(im), shape[2])
@@ -0,0 +1,194 @@
+"""
+Lazily loaded image array
+
+Images are decoded the first time they are accessed, by a pool of worker threads, and kept in a least recently used
+cache limited to a number of bytes. Nothing is loaded up front, so training can start immediately and the dataset can
+be larger than the available RAM and disk.
+
+If the order in which the images will be accessed is known (e.g. the shuffled indices of an epoch), it can be given
+using set_access_order, and the images are decoded ahead of their use.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from miso.data.cache_manager import parse_size
+from miso.data.image_loader import load
+
+
+class LazyImageArray:
+    def __init__(self,
+                 filenames,
+                 img_size,
+                 transform_fn=None,
+                 transform_args=None,
+                 dtype=np.uint8,
+                 cache_size="4G",
+                 num_workers=8,
+                 read_ahead=256,
+                 read_fn=None):
+        """
+        Array of images that are loaded on access. Behaves like a read-only array of shape (len(filenames), *img_size)
+        :param filenames: Filenames of the images
+        :param img_size: Size of the transformed images
+        :param transform_fn: Function applied to each image after loading
+        :param transform_args: Extra arguments for the transform function
+        :param dtype: Data type of the images
+        :param cache_size: Maximum size of the decoded image cache in bytes (or a string such as "4G")
+        :param num_workers: Number of decoding threads
+        :param read_ahead: Number of images to decode ahead of the current position in the access order
+        :param read_fn: Function that reads an image given its filename, if None skimage.io.imread is used
+        """
+        self.filenames = filenames
+        self.transform_fn = transform_fn
+        self.transform_args = transform_args
+        self.read_fn = read_fn
+        self.shape = (len(filenames),) + tuple(img_size)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.item_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        self.cache_size = parse_size(cache_size)
+        self.read_ahead = read_ahead
+        self.num_workers = num_workers
+
+        self.cache = OrderedDict()
+        self.pending = dict()
+        self.prefetched = set()
+        self.streams = dict()
+        self.lock = threading.RLock()
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+        self.requests = 0
+        self.hits = 0
+        self.prefetch_hits = 0
+        self.stall_time = 0.0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def decode(self, idx):
+        im = load(self.filenames[idx], self.transform_fn, self.transform_args, self.read_fn)
+        return np.asarray(im, dtype=self.dtype).reshape(self.shape[1:])
+
+    def set_access_order(self, idxs, stream=None):
+        """
+        Sets the order in which the images will be accessed, so that they can be decoded ahead of use
+        :param idxs: Indices in access order
+        :param stream: Identifier of the stream of accesses, so that several generators (e.g. training and validation)
+        can read ahead independently
+        """
+        with self.lock:
+            self.streams[stream] = [np.asarray(idxs), 0]
+            self._read_ahead(stream)
+
+    def _read_ahead(self, stream):
+        idxs, position = self.streams[stream]
+        # Do not read further ahead than the cache can hold
+        count = min(self.read_ahead, max(1, self.cache_size // max(self.item_bytes, 1) // 2))
+        for idx in idxs[position:position + count]:
+            idx = int(idx)
+            if idx not in self.cache and idx not in self.pending:
+                future = self.pool.submit(self.decode, idx)
+                self.pending[idx] = future
+                future.add_done_callback(lambda f, idx=idx: self._on_decoded(idx, f))
+
+    def _on_decoded(self, idx, future):
+        # Images decoded ahead of use are moved to the cache
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            if self.pending.get(idx) is future:
+                del self.pending[idx]
+                self.prefetched.add(idx)
+                self._insert(idx, future.result())
+
+    def _advance(self, idx):
+        for stream, (idxs, position) in self.streams.items():
+            if position < len(idxs) and idxs[position] == idx:
+                self.streams[stream][1] = position + 1
+                self._read_ahead(stream)
+
+    def _insert(self, idx, im):
+        self.cache[idx] = im
+        while len(self.cache) * self.item_bytes > self.cache_size and len(self.cache) > 1:
+            evicted, _ = self.cache.popitem(last=False)
+            self.prefetched.discard(evicted)
+
+    def get(self, idx):
+        """
+        Returns the image at index idx, decoding it if it is not in the cache
+        """
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        with self.lock:
+            self.requests += 1
+            self._advance(idx)
+            if idx in self.cache:
+                if idx in self.prefetched:
+                    self.prefetched.discard(idx)
+                    self.prefetch_hits += 1
+                else:
+                    self.hits += 1
+                self.cache.move_to_end(idx)
+                return self.cache[idx]
+            future = self.pending.pop(idx, None)
+        # Not in the cache, wait for the image to be decoded
+        start = time.time()
+        im = future.result() if future is not None else self.decode(idx)
+        with self.lock:
+            self.stall_time += time.time() - start
+            self._insert(idx, im)
+        return im
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            selected = self[item[0]]
+            if np.ndim(item[0]) == 0 and not isinstance(item[0], slice):
+                return selected[item[1:]]
+            return selected[(slice(None),) + item[1:]]
+        if isinstance(item, slice):
+            item = np.arange(len(self))[item]
+        if np.ndim(item) == 0:
+            return self.get(item)
+        out = np.empty((len(item),) + self.shape[1:], dtype=self.dtype)
+        for i, idx in enumerate(item):
+            out[i] = self.get(idx)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[np.arange(len(self))]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def stats(self):
+        """
+        Cache statistics since the last reset
+        :return: Dictionary of the number of requests, cache hit rate (fraction of requests already in the cache),
+        read ahead hit rate (fraction of requests decoded ahead of use), decode stall time in seconds (time spent
+        waiting for images to be decoded) and cache size in bytes
+        """
+        requests = max(self.requests, 1)
+        return OrderedDict([('requests', self.requests),
+                            ('cache_hit_rate', self.hits / requests),
+                            ('read_ahead_hit_rate', self.prefetch_hits / requests),
+                            ('decode_stall_time', self.stall_time),
+                            ('cached_bytes', len(self.cache) * self.item_bytes)])
+
+    def reset_stats(self):
+        self.requests = 0
+        self.hits = 0
+        self.prefetch_hits = 0
+        self.stall_time = 0.0
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.prefetched.clear()
+        self.cache.clear()
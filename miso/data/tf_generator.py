@@ -1,9 +1,20 @@
+import collections
+
 import numpy as np
 import tensorflow as tf
 import tensorflow.keras.backend as K
 from imblearn.under_sampling import RandomUnderSampler
 
 
+def batch_map_fn(fn):
+    """
+    Marks a map function as able to process a whole batch at once (e.g. element-wise operations), so that the 'index'
+    pipeline can apply it to the batch instead of to each image
+    """
+    fn.batched = True
+    return fn
+
+
 class TFGenerator(object):
     def __init__(self,
                  data,
@@ -16,7 +27,11 @@ class TFGenerator(object):
                  one_shot=False,
                  undersample=False,
                  data_dtype=tf.float32,
-                 labels_dtype=tf.float32):
+                 labels_dtype=None,
+                 output_channels=None,
+                 pipeline='generator',
+                 variants=None,
+                 random_seed=None):
         """
         Class to create a tf.data.Dataset given a set of data and associated labels.
         Use the create() function to return the dataset
@@ -28,12 +43,30 @@ class TFGenerator(object):
         :param prefetch: How many batches to prefetch
         :param map_fn: Function applied to the data when creating a batch. Must take a tensor as input
         :param one_shot: If True, dataset will only iterate through the data once. (Use for validation / inference etc)
+        :param labels_dtype: Type of the labels output, if None int32 for class indices and float32 otherwise
+        :param output_channels: Number of channels to output. Single channel data is repeated to this number of
+        channels after the map function, so that greyscale images can be stored with one channel for three channel
+        models. If None the data is output as is.
+        :param pipeline: 'generator' - a python generator yields each image and the map function is applied to each
+        image. 'index' - a python generator yields the indices of each batch, the batch is gathered from the data in one
+        read and the map function is applied to the batch if it is marked with batch_map_fn, otherwise to each image
+        of the batch. The 'index' pipeline is much faster, it requires tensorflow 2.
+        :param variants: Number of variants of each sample in the data (e.g. an augmentation bank). The data holds the
+        variants of sample i at rows i * variants to (i + 1) * variants - 1, and a random variant of each sample is used
+        each epoch. If None, each sample is one row of the data.
+        :param random_seed: Seed of the random number generator used to shuffle the data and choose variants
         """
         self.data = data
         self.data_dtype = data_dtype
         if isinstance(cls, list):
             cls = np.asarray(cls)
         self.labels = cls
+        if labels_dtype is None:
+            # Class indices (sparse labels) or one-hot vectors
+            if cls is not None and np.ndim(cls) == 1 and np.issubdtype(np.asarray(cls).dtype, np.integer):
+                labels_dtype = tf.int32
+            else:
+                labels_dtype = tf.float32
         self.labels_dtype = labels_dtype
         self.batch_size = batch_size
         self.shuffle = shuffle
@@ -41,8 +74,18 @@ class TFGenerator(object):
         self.map_fn = map_fn
         self.one_shot = one_shot
         self.undersample = undersample
+        self.output_channels = output_channels
+        if pipeline not in ('generator', 'index'):
+            raise ValueError("pipeline must be 'generator' or 'index'")
+        self.pipeline = pipeline
+        self.variants = variants
+        self.rng = np.random.RandomState(random_seed)
+        # Start of the recent passes through the data, to find the state of the generator at a given sample
+        self.passes = collections.deque(maxlen=4)
+        self.pass_start = 0
+        self.skip = 0
         if idxs is None:
-            self.idxs = np.arange(len(data))
+            self.idxs = np.arange(len(data) if variants is None else len(data) // variants)
         else:
             self.idxs = idxs.copy()
         self.on_epoch_end()
@@ -55,7 +98,7 @@ class TFGenerator(object):
 
     def on_epoch_end(self):
         if self.undersample:
-            rus = RandomUnderSampler()
+            rus = RandomUnderSampler(random_state=self.rng)
             if isinstance(self.labels[0], np.ndarray):
                 c = np.argmax(self.labels, axis=-1)
             else:
@@ -63,7 +106,7 @@ class TFGenerator(object):
             x, y = rus.fit_sample(self.idxs.reshape(-1, 1), c[self.idxs])
             x = x.flatten()
             #y = y.flatten()
-            np.random.shuffle(x)
+            self.rng.shuffle(x)
             #print(len(x))
             #print(np.unique(y, return_counts=True))
             #np.random.shuffle(y)
@@ -72,30 +115,167 @@ class TFGenerator(object):
             #print()
             self.idxs = x
         elif self.shuffle:
-            np.random.shuffle(self.idxs)
+            self.rng.shuffle(self.idxs)
+
+    def data_rows(self, idxs):
+        """
+        Rows of the data to use for the given samples, choosing a random variant of each sample if there are variants
+        """
+        if self.variants is None:
+            return idxs
+        return idxs * self.variants + self.rng.randint(0, self.variants, len(idxs))
+
+    def start_pass(self):
+        """
+        Starts a pass through the data, recording the state at its start
+        :return: the sample indices and data rows of the pass, less any samples to skip after restoring a state
+        """
+        self.passes.append({'start': self.pass_start, 'idxs': self.idxs.copy(), 'rng': self.rng.get_state()})
+        self.pass_start += len(self.idxs)
+        rows = self.data_rows(self.idxs)
+        skip, self.skip = self.skip, 0
+        return self.idxs[skip:], rows[skip:]
+
+    def get_state(self, samples):
+        """
+        State of the generator at a position in the stream of samples, e.g. the number of samples used for training so
+        far. The position must be in one of the recent passes through the data (the generator can run ahead of the
+        training as batches are prefetched)
+        :param samples: Number of samples generated before the position
+        :return: dictionary with the order of the samples and random state at the start of the pass and the number of
+        samples of the pass before the position
+        """
+        # Start of the next pass (e.g. before any data has been generated)
+        if samples == self.pass_start:
+            return {'idxs': self.idxs.copy(), 'rng': self.rng.get_state(), 'skip': 0, 'start': self.pass_start}
+        for state in reversed(self.passes):
+            if state['start'] <= samples:
+                return {'idxs': state['idxs'].copy(), 'rng': state['rng'], 'skip': samples - state['start'],
+                        'start': state['start']}
+        raise ValueError("Sample {} is before the recorded passes through the data".format(samples))
+
+    def set_state(self, state):
+        """
+        Restores a state from get_state, so that the generator continues from the same position with the same order
+        and variants of the samples
+        """
+        self.idxs = state['idxs'].copy()
+        self.rng.set_state(state['rng'])
+        self.pass_start = state['start']
+        self.skip = state['skip']
+        self.passes.clear()
+        # Move on to the next pass if the position is at the end of this one
+        while 0 < len(self.idxs) <= self.skip:
+            self.data_rows(self.idxs)
+            self.pass_start += len(self.idxs)
+            self.skip -= len(self.idxs)
+            self.on_epoch_end()
 
     def generator(self):
         """
         Generates pairs of data and optionally, cls. After all data is processed, the index is randomised
         :return: generator of (data[i], cls[i])
         """
+        idxs, rows = self.start_pass()
+        # Lazily loaded data can decode ahead of use if it knows the order
+        if hasattr(self.data, 'set_access_order'):
+            self.data.set_access_order(rows, stream=id(self))
         i = 0
-        while i < len(self.idxs):
-            idx = self.idxs[i]
+        while i < len(idxs):
+            idx = idxs[i]
             if self.labels is None:
-                yield self.data[idx]
+                yield self.data[rows[i]]
             else:
-                yield (self.data[idx], self.labels[idx])
+                yield (self.data[rows[i]], self.labels[idx])
             i += 1
         self.on_epoch_end()
 
+    def index_generator(self):
+        """
+        Generates the indices of each batch. Batches are the same as those made by batching the output of generator():
+        if not one shot, the images left over at the end of an epoch start the first batch of the next epoch.
+        :return: generator of arrays of shape (2, batch size), the data rows and the sample indices of each batch
+        """
+        leftover = np.zeros((2, 0), dtype=np.int64)
+        while True:
+            pass_idxs, rows = self.start_pass()
+            if hasattr(self.data, 'set_access_order'):
+                self.data.set_access_order(rows, stream=id(self))
+            idxs = np.concatenate((leftover, np.stack((rows, pass_idxs))), axis=1)
+            num_batches = idxs.shape[1] // self.batch_size
+            for i in range(num_batches):
+                yield idxs[:, i * self.batch_size:(i + 1) * self.batch_size]
+            leftover = idxs[:, num_batches * self.batch_size:]
+            self.on_epoch_end()
+            if self.one_shot:
+                if leftover.shape[1] > 0:
+                    yield leftover
+                return
+
+    def gather(self, idxs):
+        """
+        Reads the data (and labels) of a batch, reading the data in row order. Data that is read ahead in the access
+        order (e.g. lazily loaded images) is read in batch order instead.
+        :param idxs: Array of shape (2, batch size), the data rows and the sample indices
+        """
+        rows, idxs = idxs
+        if hasattr(self.data, 'set_access_order'):
+            data = self.data[rows]
+        else:
+            order = np.argsort(rows, kind='stable')
+            data = np.empty((len(rows),) + tuple(self.data.shape[1:]), dtype=self.data.dtype)
+            data[order] = self.data[rows[order]]
+        if self.labels is None:
+            return data
+        return data, np.asarray(self.labels[idxs], dtype=self.labels_dtype.as_numpy_dtype)
+
+    def map_batch(self, x):
+        """
+        Applies the map function to a batch and repeats the channels to output_channels
+        """
+        x = tf.cast(x, self.data_dtype)
+        if self.map_fn is not None:
+            if getattr(self.map_fn, 'batched', False):
+                x = self.map_fn(x)
+            else:
+                x = tf.map_fn(self.map_fn, x, parallel_iterations=self.batch_size)
+        if self.output_channels is not None and self.output_channels != self.data.shape[-1]:
+            x = tf.tile(x, [1] * (len(self.data.shape) - 1) + [self.output_channels])
+        return x
+
+    def to_tfdataset_index(self):
+        """
+        Creates the tf.data.Dataset using the 'index' pipeline
+        :return: A tf.data.Dataset that iterates through batches of (data, label) pairs
+        """
+        ds = tf.data.Dataset.from_generator(self.index_generator,
+                                            output_types=tf.int64,
+                                            output_shapes=(2, None))
+        data_shape = (None,) + tuple(self.data.shape[1:])
+        data_dtype = tf.as_dtype(self.data.dtype)
+        if self.labels is None:
+            def read(idxs):
+                x = tf.numpy_function(self.gather, [idxs], data_dtype)
+                x.set_shape(data_shape)
+                return self.map_batch(x)
+        else:
+            label_shape = (None,) + tuple(np.shape(self.labels)[1:])
+
+            def read(idxs):
+                x, y = tf.numpy_function(self.gather, [idxs], [data_dtype, self.labels_dtype])
+                x.set_shape(data_shape)
+                y.set_shape(label_shape)
+                return self.map_batch(x), y
+        ds = ds.map(read, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return ds.prefetch(self.prefetch)
+
     def to_tfdataset(self):
         """
         Creates the tf.data.Dataset
         :return: A tf.data.Dataset that iterates through batches of (data, label) pairs
         """
-        if isinstance(self.labels, list) or np.ndim(self.labels) <= 1:
-            label_shape = None
+        if np.ndim(self.labels) <= 1:
+            label_shape = ()
         else:
             label_shape = self.labels[0].shape
         if self.labels is not None:
@@ -113,13 +293,23 @@ class TFGenerator(object):
 
         Note that the map function has to take a Tensor input
         """
-        if self.map_fn is not None:
-            ds = ds.map(lambda x, y: (self.map_fn(x), y), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if self.map_fn is not None or self.output_channels is not None:
+            ds = ds.map(lambda x, y: (self.map_data(x), y), num_parallel_calls=tf.data.experimental.AUTOTUNE)
         if self.one_shot is False:
             ds = ds.repeat()
         ds = ds.batch(self.batch_size).prefetch(self.prefetch)
         return ds
 
+    def map_data(self, x):
+        """
+        Applies the map function and repeats the channels to output_channels
+        """
+        if self.map_fn is not None:
+            x = self.map_fn(x)
+        if self.output_channels is not None and self.output_channels != self.data.shape[-1]:
+            x = tf.tile(x, [1] * (len(self.data.shape) - 2) + [self.output_channels])
+        return x
+
     def tf1_compat_generator_error(self):
         # Get shapes from input data
         images = self.data
@@ -151,8 +341,8 @@ class TFGenerator(object):
                 yield inputs, labels
 
     def tf1_compat_generator(self):
-        if isinstance(self.labels, list) or np.ndim(self.labels) <= 1:
-            label_shape = None
+        if np.ndim(self.labels) <= 1:
+            label_shape = ()
         else:
             label_shape = self.labels[0].shape
         if self.labels is not None:
@@ -163,8 +353,8 @@ class TFGenerator(object):
             ds = tf.data.Dataset.from_generator(self.generator,
                                                 output_types=self.data_dtype,
                                                 output_shapes=self.data[0].shape)
-        if self.map_fn is not None:
-            ds = ds.map(lambda x, y: (self.map_fn(x), y), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if self.map_fn is not None or self.output_channels is not None:
+            ds = ds.map(lambda x, y: (self.map_data(x), y), num_parallel_calls=tf.data.experimental.AUTOTUNE)
         if self.one_shot is False:
             ds = ds.repeat()
         ds = ds.batch(self.batch_size).prefetch(self.prefetch)
@@ -179,17 +369,21 @@ class TFGenerator(object):
 
     def create(self):
         if int(tf.__version__[0]) == 2:
+            if self.pipeline == 'index':
+                return self.to_tfdataset_index()
             return self.to_tfdataset()
         else:
             return self.tf1_compat_generator()
 
     @staticmethod
+    @batch_map_fn
     def map_fn_divide_255(t):
         t = tf.cast(t, tf.float32)
         return tf.divide(t, 255.0)
 
     @staticmethod
     def map_fn_divide_255_and_rotate_fn(k):
+        @batch_map_fn
         def wrapper(t):
             t = tf.cast(t, tf.float32)
             t = tf.image.rot90(t, k)
@@ -19,7 +19,18 @@ class TrainingDataset(object):
                  map_others=False,
                  test_split=0.2,
                  random_seed=0,
-                 memmap_directory=None):
+                 memmap_directory=None,
+                 loader_backend='process',
+                 incremental_cache=False,
+                 cache_identity='stat',
+                 cache_quota=None,
+                 cache_pyramid=None,
+                 lazy=False,
+                 lazy_cache_size="4G",
+                 resize_backend='skimage',
+                 decoder='skimage',
+                 pipeline='generator',
+                 sparse_labels=False):
         if len(img_size) != 3:
             raise ValueError("img_size must be in format [height, width, num_channels]")
         self.source = source
@@ -30,6 +41,17 @@ class TrainingDataset(object):
         self.test_split = test_split
         self.random_seed = random_seed
         self.memmap_directory = memmap_directory
+        self.loader_backend = loader_backend
+        self.incremental_cache = incremental_cache
+        self.cache_identity = cache_identity
+        self.cache_quota = cache_quota
+        self.cache_pyramid = cache_pyramid
+        self.lazy = lazy
+        self.lazy_cache_size = lazy_cache_size
+        self.resize_backend = resize_backend
+        self.decoder = decoder
+        self.pipeline = pipeline
+        self.sparse_labels = sparse_labels
 
         self.filenames: FilenamesDataset = None
         self.images: ImageDataset = None
@@ -37,6 +59,7 @@ class TrainingDataset(object):
         self.test_idx = None
         self.cls = None
         self.cls_onehot = None
+        self.labels = None
         self.cls_labels = None
         self.num_classes = None
         self.class_weights = None
@@ -57,8 +80,12 @@ class TrainingDataset(object):
         self.cls_labels = fs.cls_labels
         self.num_classes = fs.num_classes
 
-        # Create one hot
-        self.cls_onehot = to_categorical(fs.cls)
+        # Labels used for training: class indices (sparse) or one hot vectors
+        if self.sparse_labels:
+            self.labels = np.asarray(fs.cls, dtype=np.int16 if self.num_classes < 2 ** 15 else np.int32)
+        else:
+            self.cls_onehot = to_categorical(fs.cls)
+            self.labels = self.cls_onehot
 
         # Class weights
         weights = gmean(fs.cls_counts) / fs.cls_counts
@@ -76,16 +103,32 @@ class TrainingDataset(object):
         to_greyscale = False
         if self.img_type == 'k' or self.img_type == 'greyscale':
             to_greyscale = True
+        # Greyscale images are stored with one channel and repeated to the model's number of channels by the generator
+        store_size = list(self.img_size)
+        output_channels = None
+        if to_greyscale and store_size[2] == 3:
+            store_size[2] = 1
+            output_channels = 3
         # print(self.img_size)
         self.images = ImageDataset(self.filenames.filenames,
-                                   self.cls_onehot,
-                                   transform_fn='resize_with_pad',
-                                   transform_args=[self.img_size, to_greyscale],
-                                   memmap_directory=self.memmap_directory)
+                                   self.labels,
+                                   transform_fn='resize_with_pad_fast' if self.resize_backend == 'fast' else 'resize_with_pad',
+                                   transform_args=[store_size, to_greyscale],
+                                   memmap_directory=self.memmap_directory,
+                                   loader_backend=self.loader_backend,
+                                   incremental=self.incremental_cache,
+                                   file_identity=self.cache_identity,
+                                   cache_quota=self.cache_quota,
+                                   pyramid=self.cache_pyramid,
+                                   lazy=self.lazy,
+                                   lazy_cache_size=self.lazy_cache_size,
+                                   decoder=self.decoder,
+                                   output_channels=output_channels,
+                                   pipeline=self.pipeline)
         self.images.load()
 
-    def train_generator(self, batch_size=32, shuffle=True, one_shot=False, undersample=False, map_fn=TFGenerator.map_fn_divide_255):
-        return self.images.create_generator(batch_size, self.train_idx, map_fn=map_fn, shuffle=shuffle, one_shot=one_shot, undersample=undersample)
+    def train_generator(self, batch_size=32, shuffle=True, one_shot=False, undersample=False, map_fn=TFGenerator.map_fn_divide_255, random_seed=None):
+        return self.images.create_generator(batch_size, self.train_idx, map_fn=map_fn, shuffle=shuffle, one_shot=one_shot, undersample=undersample, random_seed=random_seed)
 
     def test_generator(self, batch_size=32, shuffle=True, one_shot=False, undersample=False, map_fn=TFGenerator.map_fn_divide_255):
         return self.images.create_generator(batch_size, self.test_idx, map_fn=map_fn, shuffle=shuffle, one_shot=one_shot, undersample=undersample)
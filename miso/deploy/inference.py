@@ -6,6 +6,7 @@ import tensorflow as tf
 from tensorflow.keras.utils import Sequence, OrderedEnqueuer
 import numpy as np
 from miso.archive.datasource import DataSource
+from miso.deploy.prediction import predict_to_array
 import lxml.etree as ET
 from tensorflow.python.platform import gfile
 import tensorflow.keras.backend as K
@@ -115,25 +116,25 @@ def process(network_info, images_dir, output_dir, threshold=0.8):
     print("Workers: {}".format(workers))
     print()
 
-    filenames = []
-    cls_index = []
-    cls_names = []
-    score = []
     enq = OrderedEnqueuer(gen, use_multiprocessing=True)
     enq.start(workers=workers, max_queue_size=multiprocessing.cpu_count()*4)
     output_generator = enq.get()
-    for i in range(len(gen)):
-        print("\r{} / {}".format(i, len(gen)), end='')
-        batch_filenames, batch_images = next(output_generator)
-        result = session.run(output_tensor, feed_dict={input_tensor: batch_images})
-        cls = np.argmax(result, axis=1)
-        scr = np.max(result, axis=1)
-        cls_name = [cls_labels[i] for i in cls]
-        filenames.extend(batch_filenames)
-        cls_index.extend(cls)
-        cls_names.extend(cls_name)
-        score.extend(scr)
+
+    def batches():
+        for i in range(len(gen)):
+            print("\r{} / {}".format(i, len(gen)), end='')
+            batch_filenames, batch_images = next(output_generator)
+            yield batch_images
+
+    # The enqueuer keeps the batches in order, so the results are in the order of the filenames
+    result = predict_to_array(lambda x: session.run(output_tensor, feed_dict={input_tensor: x}),
+                              batches(),
+                              count=len(gen.filenames))
     enq.stop()
+    filenames = gen.filenames
+    cls_index = np.argmax(result, axis=1)
+    score = np.max(result, axis=1)
+    cls_names = [cls_labels[i] for i in cls_index]
     print()
     print("Done")
     print("See {} for results".format(output_dir))
@@ -0,0 +1,65 @@
+"""
+Prediction into preallocated arrays
+
+The outputs of each batch are written into arrays allocated once for the whole dataset, instead of collecting the
+batches in a list and concatenating them (which holds the results twice in memory). The arrays can be stored as
+float16 and can be memory mapped to temporary files on disk for datasets whose outputs do not fit in RAM.
+"""
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+
+def allocate(shape, dtype, memmap_directory=None):
+    """
+    Allocates an array in RAM, or memory mapped to a temporary file in memmap_directory that is deleted when the
+    array is no longer used
+    """
+    if memmap_directory is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(tempfile.TemporaryFile(dir=memmap_directory, suffix=".npy"), dtype=dtype, mode='w+', shape=shape)
+
+
+def predict_to_array(model, generator, count=None, dtype=None, memmap_directory=None):
+    """
+    Runs a model over all the batches of a generator, writing the outputs of each batch into preallocated arrays
+    :param model: Keras model, or a function that takes a batch of inputs and returns the output(s)
+    :param generator: One shot TFGenerator, or an iterable of batches (count must then be given). Labels in the
+    batches are ignored
+    :param count: Total number of samples, if None len(generator.idxs)
+    :param dtype: Data type of the output arrays (e.g. np.float16 to halve the memory), if None the model output type
+    :param memmap_directory: If not None, the output arrays are memory mapped to temporary files in this directory
+    :return: Array of the outputs, or a list of arrays if the model has several outputs
+    """
+    if count is None:
+        count = len(generator.idxs)
+        batches = generator.create()
+    else:
+        batches = generator
+    predict_fn = model.predict_on_batch if hasattr(model, 'predict_on_batch') else model
+    outputs = None
+    multiple = False
+    i = 0
+    try:
+        for batch in iter(batches):
+            if isinstance(batch, tuple):
+                batch = batch[0]
+            results = predict_fn(batch)
+            multiple = isinstance(results, (list, tuple))
+            if not multiple:
+                results = [results]
+            results = [np.asarray(r) for r in results]
+            if outputs is None:
+                outputs = [allocate((count,) + r.shape[1:], r.dtype if dtype is None else dtype, memmap_directory)
+                           for r in results]
+            for output, r in zip(outputs, results):
+                output[i:i + len(r)] = r
+            i += len(results[0])
+    except tf.errors.OutOfRangeError:
+        pass
+    if outputs is None:
+        raise ValueError("The generator did not produce any batches")
+    if i != count:
+        raise ValueError("Expected {} samples but the generator produced {}".format(count, i))
+    return outputs if multiple else outputs[0]
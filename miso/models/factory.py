@@ -21,7 +21,7 @@ def generate(tp: MisoParameters):
     if tp.cnn.id.endswith('tl'):
         parts = tp.cnn.id.split("_")
         if parts[0] in TRANSFER_LEARNING_PARAMS.keys():
-            model_head, model_tail = generate_tl(tp.cnn.id, tp.dataset.num_classes, tp.cnn.img_shape)
+            model_head, model_tail = generate_tl(tp.cnn.id, tp.dataset.num_classes, tp.cnn.img_shape, tp.training.tl_tail)
             return combine_tl(model_head, model_tail)
         else:
             raise ValueError("The CNN type {} is not supported, valid CNNs are {}".format(parts[0], TRANSFER_LEARNING_PARAMS.keys()))
@@ -82,10 +82,17 @@ def generate(tp: MisoParameters):
     else:
         raise ValueError(
             "The CNN type {} is not supported, valid CNNs are base_cyclic, resnet_cyclic, efficientnetb[0-7] and {}".format(tp.cnn.id, ModelsFactory().models.keys()))
-    model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+    model.compile(optimizer='adam', loss=loss_name(tp.training.sparse_labels), metrics=['accuracy'])
     return model
 
 
+def loss_name(sparse_labels=False):
+    # Sparse labels are class indices instead of one hot vectors
+    if sparse_labels:
+        return 'sparse_categorical_crossentropy'
+    return 'categorical_crossentropy'
+
+
 def generate_tl_head(cnn_type, img_shape):
     model_head = head(cnn_type, input_shape=img_shape)
     return model_head
@@ -96,9 +103,13 @@ def generate_tl_tail(num_classes, input_shape):
     return model_tail
 
 
-def generate_tl(cnn_type, num_classes, img_shape):
+def generate_tl(cnn_type, num_classes, img_shape, tail_type='keras'):
+    # The logistic and ridge tails are linear classifiers, the others have the standard tail network
     model_head = generate_tl_head(cnn_type, img_shape)
-    model_tail = tail(num_classes, [model_head.layers[-1].output.shape[-1], ])
+    if tail_type in ('logistic', 'ridge'):
+        model_tail = tail_linear(num_classes, [model_head.layers[-1].output.shape[-1], ])
+    else:
+        model_tail = tail(num_classes, [model_head.layers[-1].output.shape[-1], ])
     return model_head, model_tail
 
 def combine_tl(model_head, model_tail):
@@ -75,6 +75,14 @@ def tail(num_classes, input_shape, dropout=(0.5, 0.5)):
     return Model(inp, outp)
 
 
+def tail_linear(num_classes, input_shape, dropout=0.5):
+    # Linear classifier on the head vectors (the vector model output is the head vector)
+    inp = Input(shape=input_shape)
+    outp = Dropout(dropout)(inp)
+    outp = Dense(num_classes, activation='softmax')(outp)
+    return Model(inp, outp)
+
+
 def tail_vector(num_classes, input_shape, dropout=(0.5, 0.5)):
     inp = Input(shape=input_shape)
     outp = Dropout(dropout[0])(inp)
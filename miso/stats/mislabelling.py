@@ -1,12 +1,25 @@
 import matplotlib.pyplot as plt
 from sklearn.neighbors import KNeighborsClassifier
 import numpy as np
+from sklearn.model_selection import StratifiedKFold
 from sklearn.utils.extmath import weighted_mode
 from sklearn.preprocessing import normalize
+import contextlib
+import multiprocessing
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
 
 from tqdm import tqdm
 
+from miso.training import tail_solvers
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 
 def find_and_save_mislabelled(images,
                               vectors,
@@ -120,3 +133,97 @@ def find_and_save_mislabelled(images,
                                  image_names[im_idx]).replace("\\", "/"))
         plt.clf()
         plt.close('all')
+
+
+def fold_probabilities(vectors_file, cls, train_idx, test_idx, num_classes, method, class_weights, num_threads):
+    """
+    Trains a tail on one fold and returns the probabilities of the held out vectors (run in a worker process)
+    """
+    vectors = np.load(vectors_file, mmap_mode='r')
+    # Without threadpoolctl the solvers use the default number of threads
+    limits = threadpool_limits(num_threads) if threadpool_limits is not None else contextlib.nullcontext()
+    with limits:
+        sample_weight = None
+        if class_weights is not None:
+            sample_weight = np.asarray(class_weights, dtype=np.float64)[cls[train_idx]]
+            sample_weight /= sample_weight.mean()
+        weights = tail_solvers.fit(method, vectors[train_idx], cls[train_idx], num_classes, sample_weight)
+        return test_idx, tail_solvers.predict(weights, vectors[test_idx])
+
+
+def out_of_fold_probabilities(vectors,
+                              cls,
+                              num_classes,
+                              folds=5,
+                              method='logistic',
+                              class_weights=None,
+                              num_workers=None,
+                              random_seed=0):
+    """
+    Class probabilities of every vector from a tail that was not trained on it. The vectors are split into k folds
+    and a tail is trained on each k-1 folds, in parallel worker processes that read the vectors from a shared read-only
+    memmap, to predict the remaining fold.
+    Args:
+        vectors: Vectors for each image
+        cls: Class label for each image
+        num_classes: Number of classes
+        folds: Number of folds
+        method: Tail type, 'logistic', 'ridge' or 'mlp'
+        class_weights: Weight of each class, or None for equal weights
+        num_workers: Number of worker processes, if None one per fold (limited to the number of CPUs)
+        random_seed: Seed for the fold split
+    Returns: Array of the out of fold class probabilities of each vector
+    """
+    cls = np.asarray(cls, dtype=np.int64)
+    if num_workers is None:
+        num_workers = min(folds, cpu_count())
+    # Split the CPUs between the workers so the solvers do not oversubscribe them
+    num_threads = max(1, cpu_count() // num_workers)
+    # The workers memory map the vectors from a temporary file instead of each receiving a copy
+    fd, vectors_file = tempfile.mkstemp(suffix=".npy")
+    os.close(fd)
+    np.save(vectors_file, np.asarray(vectors, dtype=np.float32))
+    probs = np.zeros((len(cls), num_classes), dtype=np.float32)
+    # Classes with fewer images than folds cannot be stratified, so use a plain split for them
+    min_count = np.min(np.bincount(cls)[np.unique(cls)])
+    if min_count >= folds:
+        splits = StratifiedKFold(folds, shuffle=True, random_state=random_seed).split(np.zeros(len(cls)), cls)
+    else:
+        rng = np.random.RandomState(random_seed)
+        fold = rng.permutation(len(cls)) % folds
+        splits = [(np.where(fold != i)[0], np.where(fold == i)[0]) for i in range(folds)]
+    try:
+        # Spawn the workers, forking the process after tensorflow and BLAS have started their threads can deadlock
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(fold_probabilities, vectors_file, cls, train_idx, test_idx, num_classes,
+                                       method, class_weights, num_threads)
+                       for train_idx, test_idx in splits]
+            for future in tqdm(futures):
+                test_idx, prob = future.result()
+                probs[test_idx] = prob
+    finally:
+        os.remove(vectors_file)
+    return probs
+
+
+def save_suspicious_labels(probs, cls, cls_labels, image_names, output_dir):
+    """
+    Writes a CSV of the images ranked from most to least suspicious label, i.e. in order of increasing out of fold
+    probability of their label
+    Args:
+        probs: Out of fold class probabilities of each image
+        cls: Class label for each image
+        cls_labels: List of class cls in order [class_0, class_1, ..., class_N]
+        image_names: List of ids for each image, e.g. their filenames
+        output_dir: Directory to save the results
+    Returns: None
+    """
+    cls = np.asarray(cls, dtype=np.int64)
+    label_prob = probs[np.arange(len(cls)), cls]
+    pred_cls = probs.argmax(axis=1)
+    order = np.argsort(label_prob, kind='stable')
+    with open(os.path.join(output_dir, "suspicious_labels.csv"), 'w+') as f:
+        f.write("rank, filename, label, label_probability, predicted_label, predicted_probability\n")
+        for rank, i in enumerate(order):
+            f.write("{},{},{},{:.4f},{},{:.4f}\n".format(rank + 1, image_names[i], cls_labels[cls[i]], label_prob[i],
+                                                         cls_labels[pred_cls[i]], probs[i, pred_cls[i]]))
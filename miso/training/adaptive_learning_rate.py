@@ -2,6 +2,7 @@ import tensorflow as tf
 from tensorflow.keras.callbacks import Callback
 import tensorflow.keras.backend as K
 from miso.utils.rolling_buffer import RollingBuffer
+import numpy as np
 import math
 import time
 
@@ -9,7 +10,8 @@ import time
 def graph_to_console(epoch, batch, acc, loss, val_acc, val_loss, lr_prob, lr_prob_active, time_difference):
     acc_i = round(acc * 50)
     val_acc_i = round(val_acc * 50)
-    lr_prob_i = round(lr_prob * 50)
+    # The probability is nan if the monitored value is perfectly flat
+    lr_prob_i = -1 if math.isnan(lr_prob) else round(lr_prob * 50)
 
     for j in range(51):
         if j == acc_i:
@@ -35,11 +37,17 @@ class AdaptiveLearningRateScheduler(Callback):
     Adaptive learning rate scheduler
 
     Decreases learning rate by a certain factor each time it is no longer improving
+
+    By default the monitored value is checked at the end of each epoch. If monitor_steps is set, the training loss is
+    checked every monitor_steps batches instead (the mean loss of those batches), so that the learning rate can drop
+    part way through an epoch. The window is still nb_epochs epochs long, where an epoch is the steps_per_epoch of fit,
+    which can be set to fewer steps than a pass through the data to use shorter "virtual" epochs.
     """
 
-    def __init__(self, drop_rate=0.5, nb_drops=4, nb_epochs=10, verbose=1, monitor='loss'):
+    def __init__(self, drop_rate=0.5, nb_drops=4, nb_epochs=10, verbose=1, monitor='loss', monitor_steps=None):
         super(AdaptiveLearningRateScheduler, self).__init__()
         self.monitor = monitor
+        self.monitor_steps = monitor_steps
         self.drop_rate = drop_rate
         self.nb_drops = nb_drops
         self.nb_epochs = nb_epochs
@@ -50,6 +58,11 @@ class AdaptiveLearningRateScheduler(Callback):
         self.buffer = None
         self.previous_time = None
         self.finished = False
+        self.steps_per_epoch = None
+        self.epoch_batch = 0
+        self.previous_mean_loss = 0.0
+        self.step_losses = []
+        self.restored_state = None
 
     def on_train_begin(self, logs=None):
         # if 'batch_size' in self.params and self.params['batch_size'] is not None:
@@ -57,11 +70,46 @@ class AdaptiveLearningRateScheduler(Callback):
         #     samples = self.params['samples']
         #     self.buffer = RollingBuffer(math.ceil(samples * self.nb_epochs / batch_size))
         # else:
-        self.buffer = RollingBuffer(self.nb_epochs)
+        if self.monitor_steps is None:
+            self.buffer = RollingBuffer(self.nb_epochs)
+        else:
+            self.steps_per_epoch = self.params.get('steps')
+            if self.steps_per_epoch is None:
+                raise ValueError("steps_per_epoch must be set to monitor the loss every monitor_steps batches")
+            self.buffer = RollingBuffer(max(3, math.ceil(self.nb_epochs * self.steps_per_epoch / self.monitor_steps)))
+        if self.restored_state is not None:
+            state = self.restored_state
+            for value in state['buffer']:
+                self.buffer.append(value)
+            self.drop_count = state['drop_count']
+            self.finished = state['finished']
+            self.current_batch = state['current_batch']
+            self.step_losses = list(state['step_losses'])
+            K.set_value(self.model.optimizer.lr, state['lr'])
+            self.restored_state = None
         self.previous_time = time.time()
 
+    def get_state(self):
+        """
+        State of the scheduler, to resume training from a checkpoint
+        """
+        return {'buffer': self.buffer.values().tolist(),
+                'drop_count': self.drop_count,
+                'finished': self.finished,
+                'current_batch': self.current_batch,
+                'step_losses': list(self.step_losses),
+                'lr': float(K.get_value(self.model.optimizer.lr))}
+
+    def set_state(self, state):
+        """
+        Restores a state from get_state when training begins
+        """
+        self.restored_state = state
+
     def on_epoch_begin(self, epoch, logs=None):
         self.current_epoch = epoch
+        self.epoch_batch = 0
+        self.previous_mean_loss = 0.0
 
     def on_epoch_end(self, epoch, logs=None):
         loss = logs.get("loss")
@@ -82,7 +130,8 @@ class AdaptiveLearningRateScheduler(Callback):
         self.previous_time = current_time
 
         # Update learning rate
-        self.update_learning_rate(self.current_epoch, logs)
+        if self.monitor_steps is None:
+            self.update_learning_rate(self.current_epoch, logs)
 
         # Graph to console
         if val_acc is not None:
@@ -98,12 +147,34 @@ class AdaptiveLearningRateScheduler(Callback):
 
     def on_batch_end(self, batch, logs=None):
         self.current_batch += 1
-
-    def update_learning_rate(self, count, logs):
+        self.epoch_batch += 1
+        if self.monitor_steps is None or self.finished or logs is None or logs.get('loss') is None:
+            return
+        # Tensorflow 2 logs the mean loss of the epoch so far, recover the loss of this batch from it
+        mean_loss = float(logs['loss'])
+        if int(tf.__version__[0]) == 2:
+            loss = mean_loss * self.epoch_batch - self.previous_mean_loss * (self.epoch_batch - 1)
+            self.previous_mean_loss = mean_loss
+        else:
+            loss = mean_loss
+        self.step_losses.append(loss)
+        if len(self.step_losses) == self.monitor_steps:
+            # Epochs done so far, counting part epochs
+            count = self.current_epoch + self.epoch_batch / self.steps_per_epoch
+            self.update_learning_rate(count, {self.monitor: np.mean(self.step_losses)},
+                                      min_count=self.nb_epochs * 3)
+            self.step_losses = []
+            if self.finished is True:
+                self.model.stop_training = True
+
+    def update_learning_rate(self, count, logs, min_count=None):
         monitor_value = logs.get(self.monitor)
         self.buffer.append(monitor_value)
+        # Number of epochs before the learning rate can be dropped
+        if min_count is None:
+            min_count = self.buffer.length() * 3
 
-        if count >= self.buffer.length() * 3 and self.buffer.full() and self.finished is False:
+        if count >= min_count and self.buffer.full() and self.finished is False:
             # if count % 20 == 19:
             #     lr = float(K.get_value(self.model.optimizer.lr))
             #     new_lr = lr * self.drop_rate
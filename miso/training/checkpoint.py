@@ -0,0 +1,154 @@
+import glob
+import os
+import pickle
+import threading
+import time
+
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+
+
+class TrainingCheckpoint(Callback):
+    """
+    Periodically saves the state of training so that an interrupted run can be resumed where it stopped
+
+    Saved state:
+    - model weights and optimizer state (tensorflow checkpoint)
+    - adaptive learning rate scheduler state (loss buffer, number of drops, learning rate)
+    - epoch, training history and training time
+    - training generator state (order of the samples and random state of the current pass through the data)
+
+    The variables are copied when the checkpoint is made and written to disk in the background, so training continues
+    while the checkpoint is saved. Versions of tensorflow without asynchronous checkpoints write the variables before
+    training continues. Only the latest checkpoint is kept. Random augmentation done by tensorflow ops in the
+    map function is not part of the state.
+    """
+
+    STATE_FILENAME = "checkpoint.pkl"
+
+    def __init__(self, directory, every=1, alr=None, generator=None, verbose=1):
+        """
+        :param directory: Directory to save the checkpoints in
+        :param every: Number of epochs between checkpoints
+        :param alr: The AdaptiveLearningRateScheduler, if used
+        :param generator: The training TFGenerator
+        :param verbose: Print when a checkpoint is saved
+        """
+        super(TrainingCheckpoint, self).__init__()
+        if int(tf.__version__[0]) < 2:
+            raise ValueError("Training checkpoints require tensorflow 2")
+        self.directory = directory
+        self.every = every
+        self.alr = alr
+        self.generator = generator
+        self.verbose = verbose
+        self.history = {}
+        self.samples = 0
+        self.previous_training_time = 0
+        self.start_time = None
+        self.checkpoint = None
+        self.write_options = None
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def load_state(directory):
+        """
+        Loads the state of the latest checkpoint in a directory
+        :return: the state dictionary, or None if there is no checkpoint
+        """
+        filename = os.path.join(directory, TrainingCheckpoint.STATE_FILENAME)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as fp:
+            return pickle.load(fp)
+
+    def restore(self, model):
+        """
+        Restores the latest checkpoint in the directory. Call before training, after the model is compiled.
+        :param model: The model being trained
+        :return: the epoch to start training from (0 if there is no checkpoint)
+        """
+        state = self.load_state(self.directory)
+        if state is None:
+            print("- no checkpoint found in {}, training from the start".format(self.directory))
+            return 0
+        # Optimizer variables that do not exist yet are restored when they are created
+        tf.train.Checkpoint(model=model, optimizer=model.optimizer).restore(state['prefix']).expect_partial()
+        if self.alr is not None and state['alr'] is not None:
+            self.alr.set_state(state['alr'])
+        if self.generator is not None and state['generator'] is not None:
+            self.generator.set_state(state['generator'])
+        self.history = state['history']
+        self.samples = state['samples']
+        self.previous_training_time = state['training_time']
+        print("- resuming from the checkpoint at epoch {}".format(state['epoch'] + 1))
+        return state['epoch'] + 1
+
+    def training_time(self):
+        """
+        Training time including that before the checkpoint the training resumed from
+        """
+        return self.previous_training_time + time.time() - self.start_time
+
+    def on_train_begin(self, logs=None):
+        self.start_time = time.time()
+        self.checkpoint = tf.train.Checkpoint(model=self.model, optimizer=self.model.optimizer)
+        # Asynchronous checkpoints need a recent version of tensorflow 2
+        self.write_options = None
+        if hasattr(self.checkpoint, 'sync'):
+            try:
+                self.write_options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+            except TypeError:
+                pass
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.samples += self.generator.batch_size if self.generator is not None else 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(value)
+        if (epoch + 1) % self.every == 0 or self.model.stop_training:
+            self.save(epoch)
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+    def save(self, epoch):
+        # Only one checkpoint is written at a time
+        self.wait()
+        prefix = os.path.join(self.directory, "ckpt-{}".format(epoch))
+        state = {'prefix': prefix,
+                 'epoch': epoch,
+                 'samples': self.samples,
+                 'history': {key: list(value) for key, value in self.history.items()},
+                 'training_time': self.training_time(),
+                 'alr': self.alr.get_state() if self.alr is not None else None,
+                 'generator': self.generator.get_state(self.samples) if self.generator is not None else None}
+        # The variables are copied before write returns, then saved to disk in the background
+        if self.write_options is not None:
+            self.checkpoint.write(prefix, options=self.write_options)
+        else:
+            self.checkpoint.write(prefix)
+        self.thread = threading.Thread(target=self.finish_save, args=(state,), daemon=True)
+        self.thread.start()
+
+    def finish_save(self, state):
+        if self.write_options is not None:
+            self.checkpoint.sync()
+        # Replace the state file atomically so that it always refers to a complete checkpoint
+        filename = os.path.join(self.directory, self.STATE_FILENAME)
+        with open(filename + ".tmp", 'wb') as fp:
+            pickle.dump(state, fp)
+        os.replace(filename + ".tmp", filename)
+        # Remove the previous checkpoints
+        for path in glob.glob(os.path.join(self.directory, "ckpt-*")):
+            if not os.path.basename(path).startswith(os.path.basename(state['prefix']) + "."):
+                os.remove(path)
+        if self.verbose == 1:
+            print("- checkpoint saved at epoch {}".format(state['epoch'] + 1))
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
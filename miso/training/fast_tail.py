@@ -0,0 +1,103 @@
+"""
+Fast training of transfer learning tails
+
+The tail is trained on the whole matrix of head vectors at once, on the CPU, instead of batch by batch with
+fit_generator. The trained weights are copied into a keras tail model, so the tail is combined with the head using
+combine_tl and deployed exactly as a normally trained tail.
+
+Methods:
+- 'logistic': multinomial logistic regression (sklearn, L-BFGS)
+- 'ridge': ridge regression onto the one-hot labels (closed form), with a softmax temperature fitted to the training set
+- 'mlp': the standard tail network, Dense(512, relu) -> Dense(softmax), trained with full batch L-BFGS
+"""
+import time
+
+import numpy as np
+from tensorflow.keras.callbacks import History
+
+from miso.models.transfer_learning import tail, tail_linear
+from miso.training.tail_solvers import TAIL_METHODS, cross_entropy, fit, predict
+
+
+def train_tail(method,
+               vectors,
+               labels,
+               train_idx,
+               test_idx,
+               num_classes,
+               class_weights=None,
+               views=None,
+               l2=1e-4,
+               max_iter=500,
+               record_every=10,
+               verbose=1):
+    """
+    Trains a transfer learning tail on the head vectors
+    :param method: 'logistic', 'ridge' or 'mlp'
+    :param vectors: Head vector of each image
+    :param labels: Class index of each image
+    :param train_idx: Indices of the training images
+    :param test_idx: Indices of the validation images
+    :param num_classes: Number of classes
+    :param class_weights: Weight of each class, or None for equal weights
+    :param views: Optional augmented views of each image, shape (number of images, number of views, vector size). If
+    given, every view of the training images is used for training
+    :param l2: L2 regularisation strength
+    :param max_iter: Maximum number of solver iterations
+    :param record_every: Number of iterations between entries in the history ('mlp' only)
+    :param verbose: Print progress
+    :return: The keras tail model and a keras History of the training and validation loss and accuracy
+    """
+    if method not in TAIL_METHODS:
+        raise ValueError("Tail method must be one of {}".format(TAIL_METHODS))
+    start = time.time()
+    labels = np.asarray(labels, dtype=np.int64)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if views is None:
+        x_train = vectors[train_idx]
+        y_train = labels[train_idx]
+    else:
+        x_train = np.asarray(views[train_idx], dtype=np.float32).reshape(-1, vectors.shape[1])
+        y_train = np.repeat(labels[train_idx], views.shape[1])
+    x_val = vectors[test_idx]
+    y_val = labels[test_idx]
+    if class_weights is None:
+        sample_weight = np.ones(len(y_train))
+    else:
+        sample_weight = np.asarray(class_weights, dtype=np.float64)[y_train]
+        sample_weight /= sample_weight.mean()
+
+    history = History()
+    history.epoch = []
+    history.history = {'loss': [], 'acc': [], 'val_loss': [], 'val_acc': []}
+
+    def record(predict_fn):
+        prob_train = predict_fn(x_train)
+        prob_val = predict_fn(x_val)
+        history.epoch.append(len(history.epoch))
+        history.history['loss'].append(cross_entropy(prob_train, y_train, sample_weight))
+        history.history['acc'].append(float(np.mean(prob_train.argmax(axis=1) == y_train)))
+        history.history['val_loss'].append(cross_entropy(prob_val, y_val) if len(y_val) > 0 else np.nan)
+        history.history['val_acc'].append(float(np.mean(prob_val.argmax(axis=1) == y_val)) if len(y_val) > 0 else np.nan)
+        if verbose:
+            print("- {:4d}: loss {:.4f}, acc {:.4f}, val_loss {:.4f}, val_acc {:.4f}".format(
+                history.epoch[-1], *[history.history[k][-1] for k in ['loss', 'acc', 'val_loss', 'val_acc']]))
+
+    iteration = [0]
+
+    def callback(predict_fn):
+        iteration[0] += 1
+        if iteration[0] % record_every == 0:
+            record(predict_fn)
+
+    weights = fit(method, x_train, y_train, num_classes, sample_weight, l2=l2, max_iter=max_iter, callback=callback)
+    if method != 'mlp' or iteration[0] % record_every != 0:
+        record(lambda x: predict(weights, x))
+    if method == 'mlp':
+        model_tail = tail(num_classes, [vectors.shape[1], ])
+    else:
+        model_tail = tail_linear(num_classes, [vectors.shape[1], ])
+    model_tail.set_weights(weights)
+    if verbose:
+        print("- {} tail trained in {:.1f}s".format(method, time.time() - start))
+    return model_tail, history
@@ -0,0 +1,34 @@
+from tensorflow.keras.callbacks import Callback
+
+
+class LazyImageMetrics(Callback):
+    """
+    Adds the decode cache statistics of a lazily loaded dataset to the training logs each epoch
+
+    Logged values:
+    - cache_hit_rate: fraction of images that were already in the cache
+    - read_ahead_hit_rate: fraction of images that were decoded ahead of use
+    - decode_stall_time: seconds spent waiting for images to be decoded
+    """
+
+    def __init__(self, data, verbose=1):
+        """
+        :param data: The LazyImageArray
+        :param verbose: Print the statistics each epoch
+        """
+        super(LazyImageMetrics, self).__init__()
+        self.data = data
+        self.verbose = verbose
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.data.reset_stats()
+
+    def on_epoch_end(self, epoch, logs=None):
+        stats = self.data.stats()
+        if logs is not None:
+            logs['cache_hit_rate'] = stats['cache_hit_rate']
+            logs['read_ahead_hit_rate'] = stats['read_ahead_hit_rate']
+            logs['decode_stall_time'] = stats['decode_stall_time']
+        if self.verbose == 1:
+            print("- image cache: {:.1f}% hit, {:.1f}% read ahead, {:.2f}s decode stall".format(
+                stats['cache_hit_rate'] * 100, stats['read_ahead_hit_rate'] * 100, stats['decode_stall_time']))
@@ -43,10 +43,17 @@ class TrainingParameters(Parameters):
     max_epochs = 10000
     alr_epochs = 10
     alr_drops = 4
+    alr_monitor_steps = None
+    steps_per_epoch = None
+    checkpoint_every = None
+    resume_from = None
     monitor_val_loss = False
     use_class_weights = True
     use_class_undersampling = False
     use_augmentation = True
+    pipeline = "generator"
+    tl_tail = "keras"
+    sparse_labels = False
 
 
 class DatasetParameters(Parameters):
@@ -57,6 +64,17 @@ class DatasetParameters(Parameters):
     map_others = False
     random_seed = 0
     memmap_directory = None
+    loader_backend = "process"
+    incremental_cache = False
+    cache_identity = "stat"
+    cache_quota = None
+    cache_pyramid = None
+    lazy = False
+    lazy_cache_size = "4G"
+    resize_backend = "skimage"
+    decoder = "skimage"
+    feature_cache = False
+    vector_dtype = "float32"
 
 
 class AugmentationParameters(Parameters):
@@ -68,12 +86,15 @@ class AugmentationParameters(Parameters):
     gaussian_noise = None
     random_crop = None
     orig_img_shape = [256, 256, 3]
+    offline_variants = None
+    feature_views = None
 
 
 class OutputParameters(Parameters):
     output_dir = None
     save_model = True
     save_mislabeled = True
+    mislabeled_folds = None
 
 
 class MisoParameters(Parameters):
@@ -0,0 +1,160 @@
+"""
+Solvers for training transfer learning tails on a matrix of head vectors, using only numpy, scipy and sklearn (so that
+they can be used in worker processes without tensorflow).
+
+The weights returned are those of the keras tail models: [kernel, bias] for a linear tail (tail_linear) and
+[kernel, bias, kernel, bias] for the dense tail (tail).
+"""
+import numpy as np
+from scipy.optimize import minimize, minimize_scalar
+
+TAIL_METHODS = ('logistic', 'ridge', 'mlp')
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    e = np.exp(logits)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def cross_entropy(prob, labels, sample_weight=None):
+    loss = -np.log(np.maximum(prob[np.arange(len(labels)), labels], 1e-12))
+    if sample_weight is not None:
+        loss = loss * sample_weight
+    return float(np.mean(loss))
+
+
+def fit_logistic(x, labels, num_classes, sample_weight, l2, max_iter):
+    from sklearn.linear_model import LogisticRegression
+    clf = LogisticRegression(C=1.0 / (l2 * len(x)), max_iter=max_iter)
+    clf.fit(x, labels, sample_weight=sample_weight)
+    # Classes missing from the training set are never predicted
+    w = np.zeros((x.shape[1], num_classes), dtype=np.float32)
+    b = np.full(num_classes, -30, dtype=np.float32)
+    if len(clf.classes_) == 2:
+        # Binary logistic regression, sigmoid(z) = softmax([-z/2, z/2])[1]
+        w[:, clf.classes_] = np.stack([-clf.coef_[0] / 2, clf.coef_[0] / 2], axis=1)
+        b[clf.classes_] = [-clf.intercept_[0] / 2, clf.intercept_[0] / 2]
+    else:
+        w[:, clf.classes_] = clf.coef_.T
+        b[clf.classes_] = clf.intercept_
+    return [w, b]
+
+
+def fit_ridge(x, labels, num_classes, sample_weight, l2):
+    onehot = np.eye(num_classes, dtype=np.float64)[labels]
+    xa = np.concatenate((x, np.ones((len(x), 1), dtype=x.dtype)), axis=1).astype(np.float64)
+    xw = xa * sample_weight[:, np.newaxis]
+    reg = l2 * len(x) * np.eye(xa.shape[1])
+    reg[-1, -1] = 0
+    coef = np.linalg.solve(xw.T @ xa + reg, xw.T @ onehot)
+    # Scale the scores so that their softmax best fits the training labels
+    scores = xa @ coef
+    res = minimize_scalar(lambda t: cross_entropy(softmax(scores * np.exp(t)), labels, sample_weight),
+                          bounds=(-5, 10), method='bounded')
+    coef *= np.exp(res.x)
+    return [coef[:-1].astype(np.float32), coef[-1].astype(np.float32)]
+
+
+class MLP:
+    """
+    Dense(hidden, relu) -> Dense(softmax) network, with the weights packed into one vector for scipy.optimize
+    """
+    def __init__(self, input_size, hidden, num_classes, seed=0):
+        self.shapes = [(input_size, hidden), (hidden,), (hidden, num_classes), (num_classes,)]
+        self.sizes = [int(np.prod(s)) for s in self.shapes]
+        rng = np.random.RandomState(seed)
+        # Glorot uniform, as keras
+        params = []
+        for shape in self.shapes:
+            if len(shape) == 2:
+                limit = np.sqrt(6 / (shape[0] + shape[1]))
+                params.append(rng.uniform(-limit, limit, shape))
+            else:
+                params.append(np.zeros(shape))
+        self.initial = self.pack(params)
+
+    def pack(self, params):
+        return np.concatenate([np.ravel(p) for p in params]).astype(np.float64)
+
+    def unpack(self, theta):
+        params = []
+        start = 0
+        for shape, size in zip(self.shapes, self.sizes):
+            params.append(theta[start:start + size].reshape(shape).astype(np.float32))
+            start += size
+        return params
+
+    def predict(self, theta, x):
+        w1, b1, w2, b2 = self.unpack(theta)
+        return softmax(np.maximum(x @ w1 + b1, 0) @ w2 + b2)
+
+    def loss_and_grad(self, theta, x, labels, sample_weight, l2):
+        w1, b1, w2, b2 = self.unpack(theta)
+        h = np.maximum(x @ w1 + b1, 0)
+        prob = softmax(h @ w2 + b2)
+        n = len(x)
+        loss = cross_entropy(prob, labels, sample_weight) + 0.5 * l2 * (np.sum(w1 ** 2) + np.sum(w2 ** 2))
+        d_logits = prob
+        d_logits[np.arange(n), labels] -= 1
+        d_logits *= (sample_weight / n)[:, np.newaxis]
+        g_w2 = h.T @ d_logits + l2 * w2
+        g_b2 = d_logits.sum(axis=0)
+        d_h = (d_logits @ w2.T) * (h > 0)
+        g_w1 = x.T @ d_h + l2 * w1
+        g_b1 = d_h.sum(axis=0)
+        return loss, self.pack([g_w1, g_b1, g_w2, g_b2])
+
+
+def fit(method, x, labels, num_classes, sample_weight=None, l2=1e-4, max_iter=500, callback=None):
+    """
+    Fits a tail to the vectors
+    :param method: 'logistic', 'ridge' or 'mlp'
+    :param x: Vectors, shape (number of samples, vector size)
+    :param labels: Class index of each vector
+    :param num_classes: Number of classes
+    :param sample_weight: Weight of each sample, or None for equal weights
+    :param l2: L2 regularisation strength
+    :param max_iter: Maximum number of solver iterations
+    :param callback: Function called after each iteration ('mlp' only) with a function that returns the current
+    class probabilities of a matrix of vectors
+    :return: The tail weights
+    """
+    if method not in TAIL_METHODS:
+        raise ValueError("Tail method must be one of {}".format(TAIL_METHODS))
+    x = np.asarray(x, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.int64)
+    if sample_weight is None:
+        sample_weight = np.ones(len(x))
+    # Standardise the vectors, the scaling is folded into the first layer afterwards
+    mean = x.mean(axis=0)
+    std = x.std(axis=0)
+    std[std == 0] = 1
+    x = (x - mean) / std
+    if method == 'mlp':
+        mlp = MLP(x.shape[1], 512, num_classes)
+        if callback is not None:
+            mlp_callback = lambda theta: callback(lambda v: mlp.predict(theta, (np.asarray(v) - mean) / std))
+        else:
+            mlp_callback = None
+        res = minimize(mlp.loss_and_grad, mlp.initial, args=(x, labels, sample_weight, l2), jac=True,
+                       method='L-BFGS-B', callback=mlp_callback, options={'maxiter': max_iter})
+        weights = mlp.unpack(res.x)
+    elif method == 'logistic':
+        weights = fit_logistic(x, labels, num_classes, sample_weight, l2, max_iter)
+    else:
+        weights = fit_ridge(x, labels, num_classes, sample_weight, l2)
+    weights[1] = (weights[1] - (mean / std) @ weights[0]).astype(np.float32)
+    weights[0] = (weights[0] / std[:, np.newaxis]).astype(np.float32)
+    return weights
+
+
+def predict(weights, x):
+    """
+    Class probabilities of the vectors using the tail weights
+    """
+    x = np.asarray(x, dtype=np.float32)
+    if len(weights) == 2:
+        return softmax(x @ weights[0] + weights[1])
+    w1, b1, w2, b2 = weights
+    return softmax(np.maximum(x @ w1 + b1, 0) @ w2 + b2)
@@ -1,11 +1,7 @@
 import tensorflow as tf
 import numpy as np
 
-if int(tf.__version__[0]) == 2:
-    try:
-        import tensorflow_addons as tfa
-    except ImportError:
-        pass
+from miso.data.tf_generator import batch_map_fn
 
 
 def aug_all_fn(rotation=(0, 360),
@@ -20,59 +16,184 @@ def aug_all_fn(rotation=(0, 360),
         im_x = tf.cast(im_x, tf.float32)
         if divide is not None:
             im_x = tf.divide(im_x, tf.constant(divide, dtype=tf.float32))
-        im_x = aug_rotation(im_x, rotation)
-        im_x = aug_zoom(im_x, zoom)
+        # Rotation, zoom and random crop in a single interpolation
+        im_x = aug_geometric(im_x, rotation, zoom, random_crop)
         im_x = aug_gain_gamma(im_x, gain, gamma)
         im_x = aug_gaussian_noise(im_x, gaussian_noise)
         im_x = aug_bias(im_x, bias)
-        im_x = aug_random_crop(im_x, random_crop)
         return im_x
     return wrapper
 
 
-def aug_rotation(im_x, rotation=(0, 360)):
-    if rotation is not None:
-        if len(rotation) > 2:
-            rotation_factor = tf.random.shuffle(tf.constant(rotation))[0]
-        elif len(rotation) == 2:
-            rotation_factor = tf.random.uniform([], rotation[0] / 180 * np.pi, rotation[1] / 180 * np.pi)
-        else:
-            raise ValueError("Rotation needs at least 2 values")
-        if int(tf.__version__[0]) == 2:
-            im_x = tfa.image.rotate(im_x, rotation_factor, interpolation='bilinear')
-        else:
-            im_x = tf.contrib.image.rotate(im_x, rotation_factor, interpolation='BILINEAR')
+def aug_all_batch_fn(rotation=(0, 360),
+                     gain=(0.8, 1.0, 1.2),
+                     gamma=(0.5, 1.0, 2),
+                     zoom=(0.9, 1.0, 1.1),
+                     gaussian_noise=None,
+                     bias=None,
+                     random_crop=None,
+                     divide=255):
+    """
+    Same augmentation as aug_all_fn, applied to a batch of images at once (use with the 'index' pipeline).
+    Each image gets its own random parameters, drawn from the same distributions as aug_all_fn. Rotation, zoom and
+    random crop are combined into one projective transform of the batch.
+    """
+    @batch_map_fn
+    def wrapper(im_x):
+        im_x = tf.cast(im_x, tf.float32)
+        if divide is not None:
+            im_x = tf.divide(im_x, tf.constant(divide, dtype=tf.float32))
+        im_x = aug_geometric(im_x, rotation, zoom, random_crop)
+        im_x = aug_gain_gamma_batch(im_x, gain, gamma)
+        im_x = aug_gaussian_noise_batch(im_x, gaussian_noise)
+        im_x = aug_bias_batch(im_x, bias)
+        return im_x
+    return wrapper
+
+
+def aug_geometric(im_x, rotation=(0, 360), zoom=(0.9, 1.0, 1.1), random_crop=None):
+    """
+    Random rotation, zoom and crop of an image or a batch of images, combined into one projective transform
+    """
+    if rotation is None and zoom is None and random_crop is None:
+        return im_x
+    single = im_x.shape.rank == 3
+    if single:
+        im_x = im_x[tf.newaxis]
+    n = tf.shape(im_x)[0]
+    if random_crop is not None:
+        offsets = random_crop_offsets(im_x, random_crop, n)
+        output_size = random_crop[:2]
+    else:
+        offsets = None
+        output_size = None
+    im_x = geometric_transform(im_x, random_rotation(rotation, n), random_zoom(zoom, n), offsets, output_size)
+    if single:
+        im_x = im_x[0]
     return im_x
 
 
-def aug_zoom(im_x, zoom=(0.9, 1.0, 1.1)):
-    if zoom is not None:
-        if len(zoom) > 2:
-            zoom_value = tf.random.shuffle(tf.constant(zoom))[0]
-        elif len(zoom) == 2:
-            zoom_value = tf.random.uniform([], zoom[0], zoom[1])
-        else:
-            raise ValueError("Zoom needs at least 2 values")
-        zoom_start_factor = tf.divide(tf.subtract(1.0, zoom_value), 2)
-        zoom_end_factor = tf.subtract(1.0, zoom_start_factor)
-        zoom_factor = [[zoom_start_factor, zoom_start_factor, zoom_end_factor, zoom_end_factor]]
-        if int(tf.__version__[0]) == 2:
-            im_x = tf.image.crop_and_resize([im_x],
-                                            boxes=zoom_factor,
-                                            box_indices=tf.constant([0]),
-                                            crop_size=tf.shape(im_x)[0:2],
-                                            method='bilinear',
-                                            extrapolation_value=0)[0]
-        else:
-            im_x = tf.image.crop_and_resize([im_x],
-                                            boxes=zoom_factor,
-                                            box_ind=tf.constant([0]),
-                                            crop_size=tf.shape(im_x)[0:2],
-                                            method='bilinear',
-                                            extrapolation_value=0)[0]
+def random_values(values, n, name):
+    """
+    Random value for each of n images: values of length 2 are a range to draw uniformly from, longer lists are values
+    to choose from
+    """
+    if len(values) > 2:
+        choice = tf.random.uniform([n], 0, len(values), dtype=tf.int32)
+        return tf.gather(tf.constant(values, dtype=tf.float32), choice)
+    elif len(values) == 2:
+        return tf.random.uniform([n], values[0], values[1])
+    else:
+        raise ValueError("{} needs at least 2 values".format(name))
+
+
+def random_rotation(rotation, n):
+    if rotation is None:
+        return None
+    if len(rotation) == 2:
+        return random_values([rotation[0] / 180 * np.pi, rotation[1] / 180 * np.pi], n, "Rotation")
+    return random_values(rotation, n, "Rotation")
+
+
+def random_zoom(zoom, n):
+    if zoom is None:
+        return None
+    return random_values(zoom, n, "Zoom")
+
+
+def random_crop_offsets(im_x, crop_size, n):
+    shape = tf.shape(im_x)
+    y = tf.random.uniform([n], 0, shape[1] - crop_size[0] + 1, dtype=tf.int32)
+    x = tf.random.uniform([n], 0, shape[2] - crop_size[1] + 1, dtype=tf.int32)
+    return tf.cast(tf.stack([x, y], axis=1), tf.float32)
+
+
+def geometric_transform(im_x, angles=None, zooms=None, offsets=None, output_size=None):
+    """
+    Rotates (about the centre), zooms (about the centre) and crops a batch of images in one projective transform.
+    When zooming out, the area outside the rotated image is zero, as with tf.image.crop_and_resize (the transform
+    alone would blend the border pixels into it)
+    :param im_x: Batch of images
+    :param angles: Rotation angle of each image in radians (anticlockwise), or None
+    :param zooms: Zoom of each image (values greater than one zoom out), or None
+    :param offsets: Crop offset (x, y) of each image, or None
+    :param output_size: Size of the output images (height, width), if None the input size is used
+    :return: Transformed batch
+    """
+    if angles is None and zooms is None and offsets is None:
+        return im_x
+    shape = tf.shape(im_x)
+    n = shape[0]
+    if output_size is None:
+        output_size = shape[1:3]
+    cx = (tf.cast(shape[2], tf.float32) - 1) / 2
+    cy = (tf.cast(shape[1], tf.float32) - 1) / 2
+    cos = tf.ones([n]) if angles is None else tf.cos(angles)
+    sin = tf.zeros([n]) if angles is None else tf.sin(angles)
+    z = tf.ones([n]) if zooms is None else zooms
+    ox = tf.zeros([n]) if offsets is None else offsets[:, 0]
+    oy = tf.zeros([n]) if offsets is None else offsets[:, 1]
+    # Maps output point p to input point: p_in = zR.p + zR(o - c) + c
+    a0 = z * cos
+    a1 = -z * sin
+    b0 = z * sin
+    b1 = z * cos
+    a2 = a0 * (ox - cx) + a1 * (oy - cy) + cx
+    b2 = b0 * (ox - cx) + b1 * (oy - cy) + cy
+    zeros = tf.zeros([n])
+    transforms = tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+    output_size = tf.convert_to_tensor(output_size, dtype=tf.int32)
+    im_x = tf.raw_ops.ImageProjectiveTransformV2(images=im_x,
+                                                 transforms=transforms,
+                                                 output_shape=output_size,
+                                                 interpolation='BILINEAR',
+                                                 fill_mode='CONSTANT')
+    if zooms is not None:
+        # Zero the output pixels that map outside the (rotated) image before rotation: q = z(p + o - c) + c
+        eps = 1e-3
+        x = tf.cast(tf.range(output_size[1]), tf.float32)
+        y = tf.cast(tf.range(output_size[0]), tf.float32)
+        qx = z[:, tf.newaxis] * (x[tf.newaxis, :] + ox[:, tf.newaxis] - cx) + cx
+        qy = z[:, tf.newaxis] * (y[tf.newaxis, :] + oy[:, tf.newaxis] - cy) + cy
+        inside_x = (qx >= -eps) & (qx <= 2 * cx + eps)
+        inside_y = (qy >= -eps) & (qy <= 2 * cy + eps)
+        mask = tf.logical_and(inside_y[:, :, tf.newaxis], inside_x[:, tf.newaxis, :])
+        im_x = im_x * tf.cast(mask, im_x.dtype)[..., tf.newaxis]
+    return im_x
+
+
+def aug_gain_gamma_batch(im_x, gain=(0.8, 1.0, 1.2), gamma=(0.5, 1.0, 2)):
+    if gain is None and gamma is None:
+        return im_x
+    n = tf.shape(im_x)[0]
+    if gamma is not None:
+        im_x = tf.pow(im_x, tf.reshape(random_values(gamma, n, "Gamma"), [-1, 1, 1, 1]))
+    if gain is not None:
+        im_x = im_x * tf.reshape(random_values(gain, n, "Gain"), [-1, 1, 1, 1])
     return im_x
 
 
+def aug_gaussian_noise_batch(im_x, gaussian_noise=None):
+    if gaussian_noise is None:
+        return im_x
+    stddev = random_values(gaussian_noise, tf.shape(im_x)[0], "Noise")
+    return im_x + tf.random.normal(tf.shape(im_x)) * tf.reshape(stddev, [-1, 1, 1, 1])
+
+
+def aug_bias_batch(im_x, bias=(-0.5, 0.5)):
+    if bias is None:
+        return im_x
+    return im_x + tf.reshape(random_values(bias, tf.shape(im_x)[0], "Offset"), [-1, 1, 1, 1])
+
+
+def aug_rotation(im_x, rotation=(0, 360)):
+    return aug_geometric(im_x, rotation=rotation, zoom=None)
+
+
+def aug_zoom(im_x, zoom=(0.9, 1.0, 1.1)):
+    return aug_geometric(im_x, rotation=None, zoom=zoom)
+
+
 def aug_gain_gamma(im_x, gain=(0.8, 1.0, 1.2), gamma=(0.5, 1.0, 2)):
     # Gain
     if gain is not None:
@@ -132,5 +253,8 @@ def aug_bias(im_x, bias=(-0.5, 0.5)):
 
 def aug_random_crop(im_x, crop_size):
     if crop_size is not None:
+        # Keep the channels of the image (e.g. greyscale images stored with one channel for a three channel model)
+        if len(crop_size) == 3 and im_x.shape[-1] is not None:
+            crop_size = list(crop_size[:2]) + [im_x.shape[-1]]
         im_x = tf.image.random_crop(im_x, crop_size)
     return im_x
@@ -12,34 +12,31 @@ from collections import OrderedDict
 import tensorflow.keras.backend as K
 from sklearn.manifold import TSNE
 
+from miso.data.augmentation_bank import AugmentationBank
+from miso.data.cache_manager import CacheManager
+from miso.data.feature_cache import FeatureCache
+from miso.data.image_cache import DEFAULT_CACHE_DIRECTORY
 from miso.data.tf_generator import TFGenerator
 from miso.data.training_dataset import TrainingDataset
 from miso.stats.embedding import plot_embedding
-from miso.stats.mislabelling import find_and_save_mislabelled
+from miso.stats.mislabelling import find_and_save_mislabelled, out_of_fold_probabilities, save_suspicious_labels
 from miso.training.adaptive_learning_rate import AdaptiveLearningRateScheduler
+from miso.training.checkpoint import TrainingCheckpoint
+from miso.training.fast_tail import train_tail
+from miso.training.lazy_image_metrics import LazyImageMetrics
 from miso.training.training_result import TrainingResult
 from miso.stats.confusion_matrix import *
 from miso.stats.training import *
-from miso.training.tf_augmentation import aug_all_fn
+from miso.training.tf_augmentation import aug_all_fn, aug_all_batch_fn
 from miso.deploy.saving import freeze, convert_to_inference_mode, save_frozen_model_tf2, convert_to_inference_mode_tf2, load_from_xml
 from miso.deploy.model_info import ModelInfo
+from miso.deploy.prediction import predict_to_array
 from miso.models.factory import *
 
 import matplotlib.pyplot as plt
 import pandas as pd
 
 
-def predict_in_batches(model, generator):
-    results = []
-    try:
-        for x, y in iter(generator):
-            results.append(model.predict(x))
-    except tf.errors.OutOfRangeError:
-        pass
-    results = np.concatenate(results, axis=0)
-    return results
-
-
 def train_image_classification_model(tp: MisoParameters):
     tf_version = int(tf.__version__[0])
 
@@ -84,18 +81,55 @@ def train_image_classification_model(tp: MisoParameters):
                          tp.dataset.map_others,
                          tp.dataset.val_split,
                          tp.dataset.random_seed,
-                         tp.dataset.memmap_directory)
+                         tp.dataset.memmap_directory,
+                         loader_backend=tp.dataset.loader_backend,
+                         incremental_cache=tp.dataset.incremental_cache,
+                         cache_identity=tp.dataset.cache_identity,
+                         cache_quota=tp.dataset.cache_quota,
+                         cache_pyramid=tp.dataset.cache_pyramid,
+                         lazy=tp.dataset.lazy,
+                         lazy_cache_size=tp.dataset.lazy_cache_size,
+                         resize_backend=tp.dataset.resize_backend,
+                         decoder=tp.dataset.decoder,
+                         pipeline=tp.training.pipeline,
+                         sparse_labels=tp.training.sparse_labels)
     ds.load()
     tp.dataset.num_classes = ds.num_classes
 
     # Create save lodations
     now = datetime.datetime.now()
-    save_dir = os.path.join(tp.output.save_dir, "{0}_{1:%Y%m%d-%H%M%S}".format(tp.name, now))
+    if tp.training.resume_from is not None:
+        # Continue the interrupted run in its directory
+        save_dir = tp.training.resume_from
+    else:
+        save_dir = os.path.join(tp.output.save_dir, "{0}_{1:%Y%m%d-%H%M%S}".format(tp.name, now))
     os.makedirs(save_dir, exist_ok=True)
 
+    def create_checkpoint(model, alr_cb, train_gen):
+        # Periodic checkpoints of the training state, restored if resuming
+        if tp.training.checkpoint_every is None and tp.training.resume_from is None:
+            return None, 0
+        checkpoint_cb = TrainingCheckpoint(os.path.join(save_dir, "checkpoint"),
+                                           every=tp.training.checkpoint_every or 1,
+                                           alr=alr_cb,
+                                           generator=train_gen)
+        initial_epoch = 0
+        if tp.training.resume_from is not None:
+            initial_epoch = checkpoint_cb.restore(model)
+        return checkpoint_cb, initial_epoch
+
+    def merge_checkpoint_history(checkpoint_cb, history, training_time):
+        # History and training time including those before the checkpoint that training resumed from
+        if checkpoint_cb is None:
+            return training_time
+        history.history = checkpoint_cb.history
+        history.epoch = list(range(len(next(iter(checkpoint_cb.history.values()), []))))
+        return checkpoint_cb.previous_training_time + training_time
+
     # ------------------------------------------------------------------------------
     # Transfer learning
     # ------------------------------------------------------------------------------
+    head_vectors = None
     if tp.cnn.id.endswith('tl'):
         print('-' * 80)
         print("Transfer learning network training")
@@ -107,35 +141,105 @@ def train_image_classification_model(tp: MisoParameters):
         # Calculate vectors
         print("- calculating vectors")
         t = time.time()
-        gen = ds.images.create_generator(tp.training.batch_size, shuffle=False, one_shot=True)
-        if tf_version == 2:
-            vectors = model_head.predict(gen.create())
+
+        def predict_vectors(idxs=None, map_fn=TFGenerator.map_fn_divide_255):
+            gen = ds.images.create_generator(tp.training.batch_size, idxs=idxs, map_fn=map_fn, shuffle=False,
+                                             one_shot=True)
+            return predict_to_array(model_head, gen,
+                                    dtype=tp.dataset.vector_dtype,
+                                    memmap_directory=tp.dataset.memmap_directory)
+
+        if tp.dataset.feature_cache:
+            cache_directory = tp.dataset.memmap_directory or DEFAULT_CACHE_DIRECTORY
+            cache_manager = None
+            if tp.dataset.cache_quota is not None:
+                cache_manager = CacheManager(cache_directory, tp.dataset.cache_quota)
+            feature_cache = FeatureCache(cache_directory,
+                                         tp.cnn.id,
+                                         tp.cnn.img_shape,
+                                         model_head.output_shape[1:],
+                                         dtype=tp.dataset.vector_dtype,
+                                         cache_manager=cache_manager)
+            print("- feature cache at {}".format(feature_cache.store.directory))
+            vectors = np.asarray(feature_cache.vectors(ds.images, predict_vectors))
         else:
-            vectors = predict_in_batches(model_head, gen.create())
+            vectors = predict_vectors()
         print("! {}s elapsed, ({}/{} vectors)".format(time.time() - t, len(vectors), len(ds.images.data)))
+        head_vectors = vectors
+
+        # Calculate vectors of augmented views of the images
+        views = None
+        if tp.training.use_augmentation is True and tp.augmentation.feature_views:
+            print("- calculating {} augmented views".format(tp.augmentation.feature_views))
+            t = time.time()
+            if tp.augmentation.rotation is True:
+                tp.augmentation.rotation = [0, 360]
+            elif tp.augmentation.rotation is False:
+                tp.augmentation.rotation = None
+            # Random crop is not used as the head input size is fixed
+            aug_params = OrderedDict([('rotation', tp.augmentation.rotation),
+                                      ('gain', tp.augmentation.gain),
+                                      ('gamma', tp.augmentation.gamma),
+                                      ('zoom', tp.augmentation.zoom),
+                                      ('gaussian_noise', tp.augmentation.gaussian_noise),
+                                      ('bias', tp.augmentation.bias)])
+            if tp.training.pipeline == 'index':
+                augment_fn = aug_all_batch_fn(**aug_params, random_crop=None, divide=255)
+            else:
+                augment_fn = aug_all_fn(**aug_params, random_crop=None, divide=255)
+
+            def predict_views(idxs=None):
+                return predict_vectors(idxs, augment_fn)
+
+            if tp.dataset.feature_cache:
+                view_cache = FeatureCache(cache_directory,
+                                          tp.cnn.id,
+                                          tp.cnn.img_shape,
+                                          model_head.output_shape[1:],
+                                          dtype=tp.dataset.vector_dtype,
+                                          cache_manager=cache_manager,
+                                          augmentation=dict(aug_params))
+                views = view_cache.views(ds.images, predict_views, tp.augmentation.feature_views)
+            else:
+                views = np.stack([predict_views() for i in range(tp.augmentation.feature_views)], axis=1)
+            print("! {}s elapsed, ({} views)".format(time.time() - t, views.shape[0] * views.shape[1]))
 
         # Clear session
         # K.clear_session()
 
         # Generate tail model and compile
         model_tail = generate_tl_tail(tp.dataset.num_classes, [vectors.shape[-1], ])
-        model_tail.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+        model_tail.compile(optimizer='adam', loss=loss_name(tp.training.sparse_labels), metrics=['accuracy'])
 
         # Learning rate scheduler
         alr_cb = AdaptiveLearningRateScheduler(nb_epochs=tp.training.alr_epochs,
                                                nb_drops=tp.training.alr_drops,
+                                               monitor_steps=tp.training.alr_monitor_steps,
                                                verbose=1)
         print('-' * 80)
         print("Training")
 
         # Training generator
-        train_gen = TFGenerator(vectors,
-                                ds.cls_onehot,
-                                ds.train_idx,
-                                tp.training.batch_size,
-                                shuffle=True,
-                                one_shot=False,
-                                undersample=tp.training.use_class_undersampling)
+        if views is not None:
+            # A random augmented view of each image each epoch
+            train_gen = TFGenerator(views.reshape((-1,) + views.shape[2:]),
+                                    ds.labels,
+                                    ds.train_idx,
+                                    tp.training.batch_size,
+                                    shuffle=True,
+                                    one_shot=False,
+                                    undersample=tp.training.use_class_undersampling,
+                                    variants=views.shape[1],
+                                    random_seed=tp.dataset.random_seed)
+        else:
+            train_gen = TFGenerator(vectors,
+                                    ds.labels,
+                                    ds.train_idx,
+                                    tp.training.batch_size,
+                                    shuffle=True,
+                                    one_shot=False,
+                                    undersample=tp.training.use_class_undersampling,
+                                    random_seed=tp.dataset.random_seed)
 
         # Validation generator
         if tf_version == 2:
@@ -145,7 +249,7 @@ def train_image_classification_model(tp: MisoParameters):
             val_one_shot = False
         if tp.dataset.val_split > 0:
             val_gen = TFGenerator(vectors,
-                                  ds.cls_onehot,
+                                  ds.labels,
                                   ds.test_idx,
                                   tp.training.batch_size,
                                   shuffle=False,
@@ -177,19 +281,36 @@ def train_image_classification_model(tp: MisoParameters):
         # print(v[0, :10])
 
         # Train
-        history = model_tail.fit_generator(train_gen.create(),
-                                           steps_per_epoch=len(train_gen),
-                                           validation_data=val_gen.create(),
-                                           validation_steps=len(val_gen),
-                                           epochs=tp.training.max_epochs,
-                                           verbose=0,
-                                           shuffle=False,
-                                           max_queue_size=1,
-                                           class_weight=class_weights,
-                                           callbacks=[alr_cb])
+        if tp.training.tl_tail != 'keras':
+            # Full batch training of the tail on the vectors
+            print("- training {} tail".format(tp.training.tl_tail))
+            if tp.training.use_class_undersampling:
+                print("- under sampling is not used by the {} tail".format(tp.training.tl_tail))
+            model_tail, history = train_tail(tp.training.tl_tail,
+                                             vectors,
+                                             ds.cls,
+                                             ds.train_idx,
+                                             ds.test_idx,
+                                             tp.dataset.num_classes,
+                                             class_weights=ds.class_weights if tp.training.use_class_weights else None,
+                                             views=views)
+            checkpoint_cb = None
+        else:
+            checkpoint_cb, initial_epoch = create_checkpoint(model_tail, alr_cb, train_gen)
+            history = model_tail.fit_generator(train_gen.create(),
+                                               steps_per_epoch=tp.training.steps_per_epoch or len(train_gen),
+                                               validation_data=val_gen.create(),
+                                               validation_steps=len(val_gen),
+                                               epochs=tp.training.max_epochs,
+                                               initial_epoch=initial_epoch,
+                                               verbose=0,
+                                               shuffle=False,
+                                               max_queue_size=1,
+                                               class_weight=class_weights,
+                                               callbacks=[alr_cb] + ([checkpoint_cb] if checkpoint_cb else []))
         # Elapsed time
         end = time.time()
-        training_time = end - start
+        training_time = merge_checkpoint_history(checkpoint_cb, history, end - start)
         print("- training time: {}s".format(training_time))
         time.sleep(3)
 
@@ -242,9 +363,32 @@ def train_image_classification_model(tp: MisoParameters):
             tp.augmentation.rotation = [0, 360]
         elif tp.augmentation.rotation is False:
             tp.augmentation.rotation = None
+        bank = None
         if tp.training.use_augmentation is True:
             print("- using augmentation")
-            augment_fn = aug_all_fn(rotation=tp.augmentation.rotation,
+            # Augment whole batches at once with the index pipeline
+            if tp.training.pipeline == 'index':
+                aug_fn = aug_all_batch_fn
+            else:
+                aug_fn = aug_all_fn
+            if tp.augmentation.offline_variants:
+                # Geometric augmentation is precomputed, only the photometric augmentation is done online
+                bank = AugmentationBank(ds.images,
+                                        tp.augmentation.offline_variants,
+                                        rotation=tp.augmentation.rotation,
+                                        zoom=tp.augmentation.zoom,
+                                        random_crop=tp.augmentation.random_crop)
+                bank.load()
+                augment_fn = aug_fn(rotation=None,
+                                    gain=tp.augmentation.gain,
+                                    gamma=tp.augmentation.gamma,
+                                    zoom=None,
+                                    gaussian_noise=tp.augmentation.gaussian_noise,
+                                    bias=tp.augmentation.bias,
+                                    random_crop=None,
+                                    divide=255)
+            else:
+                augment_fn = aug_fn(rotation=tp.augmentation.rotation,
                                     gain=tp.augmentation.gain,
                                     gamma=tp.augmentation.gamma,
                                     zoom=tp.augmentation.zoom,
@@ -259,18 +403,34 @@ def train_image_classification_model(tp: MisoParameters):
         # Learning rate scheduler
         alr_cb = AdaptiveLearningRateScheduler(nb_epochs=tp.training.alr_epochs,
                                                nb_drops=tp.training.alr_drops,
+                                               monitor_steps=tp.training.alr_monitor_steps,
                                                verbose=1)
 
+        callbacks = [alr_cb]
+        if tp.dataset.lazy:
+            callbacks.append(LazyImageMetrics(ds.images.data))
+
         # Training generator
-        train_gen = ds.train_generator(batch_size=tp.training.batch_size,
-                                       map_fn=augment_fn,
-                                       undersample=tp.training.use_class_undersampling)
+        if bank is not None:
+            train_gen = bank.create_generator(tp.training.batch_size,
+                                              ds.train_idx,
+                                              map_fn=augment_fn,
+                                              undersample=tp.training.use_class_undersampling,
+                                              random_seed=tp.dataset.random_seed)
+        else:
+            train_gen = ds.train_generator(batch_size=tp.training.batch_size,
+                                           map_fn=augment_fn,
+                                           undersample=tp.training.use_class_undersampling,
+                                           random_seed=tp.dataset.random_seed)
 
         # Save example of training data
         print(" - saving example training batch")
         training_examples_dir = os.path.join(save_dir, "examples", "training")
-        os.makedirs(training_examples_dir)
+        os.makedirs(training_examples_dir, exist_ok=True)
+        # Restore the generator afterwards so that training starts from the same order and random state
+        train_gen_state = train_gen.get_state(train_gen.pass_start)
         images, labels = next(iter(train_gen.create()))
+        train_gen.set_state(train_gen_state)
         for t_idx, im in enumerate(images):
             im = (im * 255)
             im[im > 255] = 255
@@ -300,24 +460,32 @@ def train_image_classification_model(tp: MisoParameters):
         if tp.training.use_class_undersampling:
             print("- class balancing using random under sampling")
 
+        # Checkpoints (after the other callbacks so that their state at the end of the epoch is saved)
+        checkpoint_cb, initial_epoch = create_checkpoint(model, alr_cb, train_gen)
+        if checkpoint_cb is not None:
+            callbacks.append(checkpoint_cb)
+
         # Train the model
         history = model.fit_generator(train_gen.create(),
-                                      steps_per_epoch=len(train_gen),
+                                      steps_per_epoch=tp.training.steps_per_epoch or len(train_gen),
                                       validation_data=val_gen.create(),
                                       validation_steps=len(val_gen),
                                       epochs=tp.training.max_epochs,
+                                      initial_epoch=initial_epoch,
                                       verbose=0,
                                       shuffle=False,
                                       max_queue_size=1,
                                       class_weight=class_weights,
-                                      callbacks=[alr_cb])
+                                      callbacks=callbacks)
 
         # Elapsed time
         end = time.time()
-        training_time = end - start
+        training_time = merge_checkpoint_history(checkpoint_cb, history, end - start)
         print()
         print("Total training time: {}s".format(training_time))
         time.sleep(3)
+        if bank is not None:
+            bank.release()
 
         # Vector model
         vector_model = generate_vector(model, tp.cnn.id)
@@ -327,36 +495,51 @@ def train_image_classification_model(tp: MisoParameters):
     # ------------------------------------------------------------------------------
     print('-' * 80)
     print("Evaluating model")
+    # Predictions and vectors of all the images in one pass, used for the metrics, mislabeled and t-SNE
+    print("- calculating predictions and vectors... ", end='')
+    if head_vectors is not None:
+        # The head vectors are already calculated so only the tail is run
+        tail_model = Model(model_tail.inputs, [model_tail.outputs[0], model_tail.get_layer(index=-2).get_output_at(0)])
+        gen = TFGenerator(head_vectors, batch_size=tp.training.batch_size, shuffle=False, one_shot=True)
+        y_prob_all, vectors = predict_to_array(tail_model, gen,
+                                               dtype=tp.dataset.vector_dtype,
+                                               memmap_directory=tp.dataset.memmap_directory)
+    else:
+        eval_model = Model(model.inputs, [model.outputs[0], vector_model.outputs[0]])
+        gen = ds.images.create_generator(tp.training.batch_size, shuffle=False, one_shot=True)
+        start = time.time()
+        y_prob_all, vectors = predict_to_array(eval_model, gen,
+                                               dtype=tp.dataset.vector_dtype,
+                                               memmap_directory=tp.dataset.memmap_directory)
+        pass_time = time.time() - start
+    print("{} total".format(len(vectors)))
     # Accuracy
     if tp.dataset.val_split > 0:
         y_true = ds.cls[ds.test_idx]
-        gen = ds.test_generator(tp.training.batch_size, shuffle=False, one_shot=True)
-        if tf_version == 2:
-            y_prob = model.predict(gen.create())
-        else:
-            y_prob = predict_in_batches(model, gen.create())
+        y_prob = y_prob_all[ds.test_idx]
         y_pred = y_prob.argmax(axis=1)
     else:
         y_true = np.asarray([])
         y_prob = np.asarray([])
         y_pred = np.asarray([])
     # Inference time
-    print("- calculating inference time:", end='')
-    max_count = np.min([128, len(ds.images.data)])
-    inf_times = []
-    for i in range(3):
-        gen = ds.images.create_generator(tp.training.batch_size, idxs=np.arange(max_count), shuffle=False, one_shot=True)
-        start = time.time()
-        if tf_version == 2:
-            model.predict(gen.create())
-        else:
-            predict_in_batches(model, gen.create())
-        end = time.time()
-        diff = (end - start) / max_count * 1000
-        inf_times.append(diff)
-        print(" {:.3f}ms".format(diff), end='')
-    inference_time = np.median(inf_times)
-    print(", median: {}".format(inference_time))
+    if head_vectors is None:
+        inference_time = pass_time / len(vectors) * 1000
+        print("- inference time: {:.3f}ms".format(inference_time))
+    else:
+        print("- calculating inference time:", end='')
+        max_count = np.min([128, len(ds.images.data)])
+        inf_times = []
+        for i in range(3):
+            gen = ds.images.create_generator(tp.training.batch_size, idxs=np.arange(max_count), shuffle=False, one_shot=True)
+            start = time.time()
+            predict_to_array(model, gen)
+            end = time.time()
+            diff = (end - start) / max_count * 1000
+            inf_times.append(diff)
+            print(" {:.3f}ms".format(diff), end='')
+        inference_time = np.median(inf_times)
+        print(", median: {}".format(inference_time))
     # Store results
     # - fix to make key same for tensorflow 1 and 2
     if 'accuracy' in history.history:
@@ -436,14 +619,7 @@ def train_image_classification_model(tp: MisoParameters):
         plt.savefig(os.path.join(save_dir, "confusion_matrix.pdf"))
         plt.close('all')
 
-    # Vectors for mislabeled and t-SNE
-    print("- calculating vectors... ", end='')
-    gen = ds.images.create_generator(tp.training.batch_size, shuffle=False, one_shot=True)
-    if tf_version == 2:
-        vectors = vector_model.predict(gen.create())
-    else:
-        vectors = predict_in_batches(vector_model, gen.create())
-    print("{} total".format(len(vectors)))
+    # Mislabeled
     if tp.output.save_mislabeled is True:
         print("- mislabeled")
         find_and_save_mislabelled(ds.images.data,
@@ -453,6 +629,24 @@ def train_image_classification_model(tp: MisoParameters):
                                   [os.path.basename(f) for f in ds.filenames.filenames],
                                   save_dir,
                                   11)
+        if tp.output.mislabeled_folds:
+            if head_vectors is None:
+                print("- out of fold label check is only available for transfer learning")
+            else:
+                print("- out of fold label check ({} folds)".format(tp.output.mislabeled_folds))
+                method = 'logistic' if tp.training.tl_tail == 'keras' else tp.training.tl_tail
+                probs = out_of_fold_probabilities(head_vectors,
+                                                  ds.cls,
+                                                  tp.dataset.num_classes,
+                                                  folds=tp.output.mislabeled_folds,
+                                                  method=method,
+                                                  class_weights=ds.class_weights if tp.training.use_class_weights else None,
+                                                  random_seed=tp.dataset.random_seed)
+                save_suspicious_labels(probs,
+                                       ds.cls,
+                                       ds.cls_labels,
+                                       [os.path.basename(f) for f in ds.filenames.filenames],
+                                       save_dir)
 
     # t-SNE
     print("- t-SNE (1024 vectors max)")
@@ -501,19 +695,15 @@ def train_image_classification_model(tp: MisoParameters):
         y_pred_old = y_pred
         y_true = ds.cls[ds.test_idx]
         gen = ds.test_generator(32, shuffle=False, one_shot=True)
-        y_prob = []
         if tf_version == 2:
             model, img_size, cls_labels = load_from_xml(os.path.join(save_dir, "model", "network_info.xml"))
-            for b in iter(gen.to_tfdataset()):
-                y_prob.append(model(b[0]).numpy())
+            y_prob = predict_to_array(model, gen)
         else:
             session, input, output, img_size, cls_labels = load_from_xml(os.path.join(save_dir, "model", "network_info.xml"))
             iterator = iter(gen.tf1_compat_generator())
-            for bi in range(len(gen)):
-                b = next(iterator)
-                y_p = session.run(output, feed_dict={input: b[0]})
-                y_prob.append(y_p)
-        y_prob = np.concatenate(y_prob, axis=0)
+            y_prob = predict_to_array(lambda x: session.run(output, feed_dict={input: x}),
+                                      (next(iterator) for bi in range(len(gen))),
+                                      count=len(gen.idxs))
         y_pred = y_prob.argmax(axis=1)
         acc = accuracy_score(y_true, y_pred)
         p, r, f1, _ = precision_recall_fscore_support(y_true, y_pred)
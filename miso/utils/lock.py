@@ -29,3 +29,52 @@
 #     s
 #     waiting)\\r\.format(datetime.now(), np.round(time.time() - start)), end = '')
 #     time.sleep(10);
+
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
+
+class FileLock:
+    """
+    Inter-process lock using a lock file, e.g. to stop several training runs updating a shared cache at the same time.
+    Use as a context manager. The lock is reentrant within the same object.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = None
+        self.depth = 0
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.fp = open(self.filename, 'a+')
+            if fcntl is not None:
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                self.fp.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self.fp.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self.fp.seek(0)
+                msvcrt.locking(self.fp.fileno(), msvcrt.LK_UNLCK, 1)
+            self.fp.close()
+            self.fp = None
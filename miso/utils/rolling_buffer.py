@@ -1,31 +1,77 @@
+import math
+
 import numpy as np
-import scipy.stats as stats
+
 
 class RollingBuffer:
+    """
+    Fixed length buffer of the most recent values, with the statistics of a linear regression of the values against
+    their position in the buffer.
+
+    The values are stored in a ring buffer and the sums needed for the regression (sum of y, y^2 and x*y) are updated
+    as values are added and removed, so appending a value and calculating the slope statistics are O(1) whatever the
+    buffer length.
+    """
+
+    # Number of appends (in multiples of the buffer length) after which the sums are recalculated to remove rounding
+    # error accumulated by the running updates
+    RESYNC_PERIOD = 16
 
     def __init__(self, buffer_len):
         self.__buffer = np.zeros(buffer_len)
-        self.__counter = 0
         self.__buffer_len = buffer_len
+        self.__start = 0
+        self.__counter = 0
+        self.__sum_y = 0.0
+        self.__sum_yy = 0.0
+        self.__sum_xy = 0.0
+        self.__appends = 0
 
     def append(self, data):
-        self.__buffer = np.roll(self.__buffer, -1)
-        self.__buffer[-1] = data
+        data = float(data)
+        if self.__counter == self.__buffer_len:
+            # Remove the oldest value, the positions of the others decrease by one
+            oldest = self.__buffer[self.__start]
+            self.__sum_y -= oldest
+            self.__sum_yy -= oldest * oldest
+            self.__sum_xy -= self.__sum_y
+            self.__start = (self.__start + 1) % self.__buffer_len
+            self.__counter -= 1
+        self.__buffer[(self.__start + self.__counter) % self.__buffer_len] = data
+        self.__sum_xy += self.__counter * data
+        self.__sum_y += data
+        self.__sum_yy += data * data
         self.__counter += 1
-        if self.__counter > self.__buffer_len:
-            self.__counter = self.__buffer_len
+        self.__appends += 1
+        if self.__appends >= self.RESYNC_PERIOD * self.__buffer_len:
+            self.__resync()
+
+    def __resync(self):
+        values = self.values()
+        self.__sum_y = float(np.sum(values))
+        self.__sum_yy = float(np.dot(values, values))
+        self.__sum_xy = float(np.dot(np.arange(len(values)), values))
+        self.__appends = 0
 
     def values(self):
-        return self.__buffer[-self.__counter:]
+        idxs = (self.__start + np.arange(self.__counter)) % self.__buffer_len
+        return self.__buffer[idxs]
 
     def mean(self):
-        return np.sum(self.__buffer) / self.__counter
+        if self.__counter == 0:
+            return 0.0
+        return self.__sum_y / self.__counter
 
     def indices(self):
         return range(self.__counter)
 
     def clear(self):
+        self.__start = 0
         self.__counter = 0
+        self.__sum_y = 0.0
+        self.__sum_yy = 0.0
+        self.__sum_xy = 0.0
+        self.__appends = 0
 
     def length(self):
         return self.__buffer_len
@@ -33,18 +79,34 @@ class RollingBuffer:
     def full(self):
         return self.__counter == self.__buffer_len
 
+    def regression(self):
+        """
+        Least squares fit of the values against their position in the buffer (0 to n-1)
+        :return: slope, intercept and the standard error of the slope
+        """
+        n = float(self.__counter)
+        sum_x = n * (n - 1) / 2
+        sum_xx = (n - 1) * n * (2 * n - 1) / 6
+        sxx = sum_xx - sum_x * sum_x / n
+        sxy = self.__sum_xy - sum_x * self.__sum_y / n
+        syy = self.__sum_yy - self.__sum_y * self.__sum_y / n
+        slope = sxy / sxx
+        intercept = (self.__sum_y - slope * sum_x) / n
+        # Sum of squared residuals, clipped as rounding can make it slightly negative
+        variance = max(syy - slope * sxy, 0.0) / (n - 2)
+        slope_std_error = math.sqrt(variance * (12.0 / (n ** 3 - n)))
+        return slope, intercept, slope_std_error
+
     def slope_probability_less_than(self, prob):
-        idxs = self.indices()
-        n = len(idxs)
-        if n < 3:
+        """
+        Probability that the slope of the values is less than prob, assuming a normal distribution of the slope
+        estimate. If the values lie exactly on a line (standard error of zero) the result is nan, as for
+        scipy.stats.norm.cdf, so the adaptive learning rate scheduler does not drop the learning rate on a perfectly
+        flat loss.
+        """
+        if self.__counter < 3:
             return 1
-        values = self.values()
-        n = float(n)
-        slope, intercept, r_value, p_value, std_err = stats.linregress(idxs, values)
-        residuals = idxs * slope + intercept
-        variance = np.sum(np.power(residuals - values, 2)) / (n - 2)
-        # print(n)
-        # print(variance)
-        slope_std_error = np.sqrt(variance * (12.0 / (np.power(n, 3) - n)))
-        p_less_than_zero = stats.norm.cdf(prob, slope, slope_std_error)
-        return p_less_than_zero
+        slope, intercept, slope_std_error = self.regression()
+        if slope_std_error == 0:
+            return float('nan')
+        return 0.5 * (1 + math.erf((prob - slope) / (slope_std_error * math.sqrt(2))))
@@ -0,0 +1,42 @@
+"""
+Benchmark of the training augmentation: images/sec for the per-image augmentation (aug_all_fn applied to each image
+before batching, as in the 'generator' pipeline) and the batch augmentation (aug_all_batch_fn applied to each batch,
+as in the 'index' pipeline)
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from miso.training.tf_augmentation import aug_all_fn, aug_all_batch_fn
+
+
+def benchmark(dataset, num_batches=100):
+    it = iter(dataset)
+    for i in range(5):
+        next(it)
+    start = time.time()
+    for i in range(num_batches):
+        batch = next(it)
+    return num_batches * batch.shape[0] / (time.time() - start)
+
+
+if __name__ == "__main__":
+    count = 1024
+    batch_size = 64
+    img_shape = (128, 128, 1)
+    params = dict(rotation=[0, 360],
+                  gain=[0.8, 1, 1.2],
+                  gamma=[0.5, 1, 2],
+                  zoom=[0.9, 1, 1.1],
+                  gaussian_noise=[0, 0.05],
+                  bias=[-0.1, 0.1],
+                  random_crop=[112, 112, 1])
+    data = np.random.RandomState(0).randint(0, 255, (count,) + img_shape, dtype=np.uint8)
+    base = tf.data.Dataset.from_tensor_slices(data).repeat()
+    per_image = base.map(aug_all_fn(**params), num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(batch_size)
+    batched = base.batch(batch_size).map(aug_all_batch_fn(**params), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    results = [("per image", benchmark(per_image)), ("batch", benchmark(batched))]
+    print()
+    for name, rate in results:
+        print("{:10s} {:10.1f} images/sec".format(name, rate))
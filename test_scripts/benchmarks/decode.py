@@ -0,0 +1,53 @@
+"""
+Benchmark of the image decoders: images/sec for reading and resizing large JPEG images with skimage and with Pillow
+(reduced resolution decoding), and the time to find the image shape by decoding versus reading the header
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import skimage.io as skio
+from PIL import Image
+
+from miso.data.image_utils import read_image, read_image_shape, resize_with_pad_transform
+
+
+def create_images(directory, count, shape):
+    rng = np.random.RandomState(0)
+    filenames = []
+    for i in range(count):
+        # Smooth random image
+        im = (rng.rand(shape[0] // 16, shape[1] // 16, *shape[2:]) * 255).astype(np.uint8)
+        im = Image.fromarray(im).resize((shape[1], shape[0]), Image.BICUBIC)
+        filename = os.path.join(directory, "{:06d}.jpg".format(i))
+        im.save(filename, quality=90)
+        filenames.append(filename)
+    return filenames
+
+
+def benchmark(filenames, decoder, img_shape):
+    start = time.time()
+    out = [resize_with_pad_transform(read_image(f, decoder, img_shape), img_shape) for f in filenames]
+    return len(filenames) / (time.time() - start), np.stack(out)
+
+
+if __name__ == "__main__":
+    count = 20
+    img_shape = (128, 128, 1)
+    with tempfile.TemporaryDirectory() as directory:
+        for src_shape in [(3000, 4000), (2000, 3000, 3), (600, 800)]:
+            filenames = create_images(directory, count, src_shape)
+            rate_ref, ref = benchmark(filenames, 'skimage', img_shape)
+            rate_pil, pil = benchmark(filenames, 'pillow', img_shape)
+            diff = np.abs(ref.astype(np.int32) - pil.astype(np.int32))
+            print("{:16s} skimage {:8.1f}  pillow {:8.1f} images/sec  ({:.1f}x, mean diff {:.2f}, max diff {})".format(
+                str(src_shape), rate_ref, rate_pil, rate_pil / rate_ref, diff.mean(), diff.max()))
+            start = time.time()
+            shapes = [skio.imread(f).shape for f in filenames]
+            decode_time = time.time() - start
+            start = time.time()
+            header_shapes = [read_image_shape(f) for f in filenames]
+            header_time = time.time() - start
+            assert shapes == header_shapes
+            print("{:16s} shape by decoding {:.4f}s, by header {:.4f}s".format("", decode_time / count, header_time / count))
@@ -0,0 +1,59 @@
+"""
+Benchmark of ParallelImageLoader: images/sec for the queue and shared memory modes, and the process and thread backends
+
+Creates a directory of random greyscale images and loads them into RAM and into a memmap using each mode.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import skimage.io as skio
+from numpy.lib.format import open_memmap
+
+from miso.data.image_loader import ParallelImageLoader
+from miso.data.image_utils import resize_with_pad_transform
+
+
+def create_images(directory, count, shape, ext="png"):
+    rng = np.random.RandomState(0)
+    filenames = []
+    for i in range(count):
+        filename = os.path.join(directory, "{:06d}.{}".format(i, ext))
+        skio.imsave(filename, rng.randint(0, 255, shape, dtype=np.uint8), check_contrast=False)
+        filenames.append(filename)
+    return filenames
+
+
+def benchmark(filenames, img_shape, mode, backend='process', memmap_file=None):
+    shape = (len(filenames),) + tuple(img_shape)
+    if memmap_file is None:
+        array = np.zeros(shape, dtype=np.uint8)
+    else:
+        array = open_memmap(memmap_file, mode='w+', dtype=np.uint8, shape=shape)
+    loader = ParallelImageLoader(filenames,
+                                 array,
+                                 transform_fn=resize_with_pad_transform,
+                                 transform_args=[img_shape, False],
+                                 mode=mode,
+                                 backend=backend)
+    start = time.time()
+    loader.load()
+    elapsed = time.time() - start
+    return len(filenames) / elapsed
+
+
+if __name__ == "__main__":
+    count = 2000
+    src_shape = (96, 128)
+    img_shape = (64, 64, 1)
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = create_images(directory, count, src_shape)
+        results = []
+        for storage in ["ram", "memmap"]:
+            for mode, backend in [("queue", "process"), ("shared", "process"), ("shared", "thread")]:
+                memmap_file = os.path.join(directory, "{}_{}.npy".format(mode, backend)) if storage == "memmap" else None
+                results.append((storage, mode, backend, benchmark(filenames, img_shape, mode, backend, memmap_file)))
+        print()
+        for storage, mode, backend, rate in results:
+            print("{:8s} {:8s} {:8s} {:10.1f} images/sec".format(storage, mode, backend, rate))
@@ -0,0 +1,60 @@
+"""
+Benchmark of RollingBuffer: time per append + slope probability (as done by the adaptive learning rate scheduler each
+step) for the ring buffer with running sums and the previous implementation (np.roll and scipy linregress), for
+increasing buffer lengths, and the difference between their results
+"""
+import time
+
+import numpy as np
+import scipy.stats as stats
+
+from miso.utils.rolling_buffer import RollingBuffer
+
+
+class ReferenceRollingBuffer:
+    """
+    Previous implementation: np.roll on each append and a full linear regression for each slope probability
+    """
+    def __init__(self, buffer_len):
+        self.buffer = np.zeros(buffer_len)
+        self.counter = 0
+        self.buffer_len = buffer_len
+
+    def append(self, data):
+        self.buffer = np.roll(self.buffer, -1)
+        self.buffer[-1] = data
+        self.counter = min(self.counter + 1, self.buffer_len)
+
+    def slope_probability_less_than(self, prob):
+        idxs = range(self.counter)
+        n = len(idxs)
+        if n < 3:
+            return 1
+        values = self.buffer[-self.counter:]
+        slope, intercept, r_value, p_value, std_err = stats.linregress(idxs, values)
+        residuals = idxs * slope + intercept
+        variance = np.sum(np.power(residuals - values, 2)) / (n - 2)
+        slope_std_error = np.sqrt(variance * (12.0 / (np.power(n, 3) - n)))
+        return stats.norm.cdf(prob, slope, slope_std_error)
+
+
+def benchmark(buffer, losses):
+    probs = np.zeros(len(losses))
+    start = time.time()
+    for i, loss in enumerate(losses):
+        buffer.append(loss)
+        probs[i] = buffer.slope_probability_less_than(0)
+    return (time.time() - start) / len(losses) * 1e6, probs
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    # Noisy decreasing training loss that flattens out
+    steps = 20000
+    losses = 2 * np.exp(-np.arange(steps) / 5000) + 0.5 + rng.randn(steps) * 0.1
+    print("{:>10s} {:>14s} {:>14s} {:>8s} {:>12s}".format("length", "reference us", "ring us", "speedup", "max diff"))
+    for buffer_len in [10, 100, 1000, 10000]:
+        t_ref, p_ref = benchmark(ReferenceRollingBuffer(buffer_len), losses)
+        t_new, p_new = benchmark(RollingBuffer(buffer_len), losses)
+        print("{:10d} {:14.1f} {:14.1f} {:7.1f}x {:12.2e}".format(
+            buffer_len, t_ref, t_new, t_ref / t_new, np.max(np.abs(p_ref - p_new))))
@@ -0,0 +1,67 @@
+"""
+Benchmark of the TFGenerator pipelines: images/sec for the 'generator' and 'index' pipelines, reading from RAM and from
+a memmap, with the default map function (divide by 255), and the read ahead hit rate and decode stall time with lazily
+loaded images that take 10ms to decode
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from miso.data.lazy_array import LazyImageArray
+from miso.data.tf_generator import TFGenerator
+
+
+def benchmark(data, cls, pipeline, batch_size=64, num_batches=200):
+    gen = TFGenerator(data, cls, batch_size=batch_size, map_fn=TFGenerator.map_fn_divide_255, pipeline=pipeline)
+    it = iter(gen.create())
+    # Warm up
+    for i in range(5):
+        next(it)
+    start = time.time()
+    for i in range(num_batches):
+        next(it)
+    return num_batches * batch_size / (time.time() - start)
+
+
+def benchmark_lazy(pipeline, count=2000, batch_size=32, num_batches=40, step_time=0.02):
+    def read(filename):
+        time.sleep(0.01)
+        return np.zeros((32, 32, 3), dtype=np.uint8)
+
+    data = LazyImageArray(["{}.jpg".format(i) for i in range(count)], (32, 32, 3), read_fn=read, read_ahead=16)
+    gen = TFGenerator(data, np.zeros(count, dtype=np.int32), batch_size=batch_size,
+                      map_fn=TFGenerator.map_fn_divide_255, pipeline=pipeline)
+    it = iter(gen.create())
+    data.reset_stats()
+    for i in range(num_batches):
+        next(it)
+        # Training step
+        time.sleep(step_time)
+    return data.stats()
+
+
+if __name__ == "__main__":
+    count = 10000
+    img_shape = (128, 128, 1)
+    num_classes = 10
+    rng = np.random.RandomState(0)
+    cls = np.eye(num_classes, dtype=np.float32)[rng.randint(0, num_classes, count)]
+    with tempfile.TemporaryDirectory() as directory:
+        memmap = open_memmap(os.path.join(directory, "data.npy"), mode='w+', dtype=np.uint8, shape=(count,) + img_shape)
+        memmap[:] = rng.randint(0, 255, memmap.shape, dtype=np.uint8)
+        ram = np.asarray(memmap).copy()
+        results = []
+        for storage, data in [("ram", ram), ("memmap", memmap)]:
+            for pipeline in ["generator", "index"]:
+                results.append((storage, pipeline, benchmark(data, cls, pipeline)))
+        print()
+        for storage, pipeline, rate in results:
+            print("{:8s} {:10s} {:10.1f} images/sec".format(storage, pipeline, rate))
+        del memmap
+    for pipeline in ["generator", "index"]:
+        stats = benchmark_lazy(pipeline)
+        print("{:8s} {:10s} {:10.1f}% read ahead hits, {:.2f}s decode stall".format(
+            "lazy", pipeline, stats['read_ahead_hit_rate'] * 100, stats['decode_stall_time']))
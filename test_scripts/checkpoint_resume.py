@@ -0,0 +1,47 @@
+"""
+Check that a TFGenerator restored from get_state continues with the same samples as the original generator, as when
+training resumes from a checkpoint. The trainer takes an example batch before training, which is included here.
+"""
+import numpy as np
+
+from miso.data.tf_generator import TFGenerator
+
+
+def take(iterator, count):
+    return [next(iterator)[1].numpy() for i in range(count)]
+
+
+def check(pipeline, example_batch, variants=3, batch_size=64, steps=7, compare_steps=20):
+    rng = np.random.RandomState(0)
+    data = rng.randn(700 * variants, 4).astype(np.float32)
+    # Label each row with its row number so that the order and variants can be compared
+    labels = np.arange(700)
+
+    def generator():
+        return TFGenerator(data, labels, np.arange(700), batch_size=batch_size, pipeline=pipeline, variants=variants,
+                           random_seed=1)
+
+    def rows(batches):
+        return np.concatenate(batches)
+
+    train_gen = generator()
+    if example_batch:
+        state = train_gen.get_state(train_gen.pass_start)
+        next(iter(train_gen.create()))
+        train_gen.set_state(state)
+    it = iter(train_gen.create())
+    take(it, steps)
+    state = train_gen.get_state(steps * batch_size)
+    expected = rows(take(it, compare_steps))
+
+    resumed_gen = generator()
+    resumed_gen.set_state(state)
+    resumed = rows(take(iter(resumed_gen.create()), compare_steps))
+    return np.array_equal(expected, resumed)
+
+
+if __name__ == "__main__":
+    for pipeline in ['generator', 'index']:
+        for example_batch in [False, True]:
+            print("{:>10s} example batch {:d}: {}".format(
+                pipeline, example_batch, "OK" if check(pipeline, example_batch) else "DIFFERENT"))